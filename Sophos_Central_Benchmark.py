@@ -0,0 +1,220 @@
+# Copyright 2019-2020 Sophos Limited
+#
+# Licensed under the GNU General Public License v3.0(the "License"); you may
+# not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+# https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Sophos_Central_Benchmark.py
+#
+# Times Sophos_Central_Health.py against Sophos_Central_Mock.py for a partner, an organization and a tenant
+# Reports the machines checked a second, API requests a second, peak memory and the too many requests answers
+# Peak MB is the main process. Shard MB is the largest shard process when Shard_Processes is more than 1
+# Uses the settings in Sophos_Central_Health.config. Change them for a run with --set, for example
+# --set PERFORMANCE.Sub_Estate_Workers=4
+# --rate-limit-check checks that runs slowed below 1 request a second, by the config or by too many requests answers,
+# still finish
+#
+# Version v2026.10
+# README: This script is an unsupported solution provided by Sophos Professional Services
+
+import argparse
+import copy
+import configparser
+import csv
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from Sophos_Central_Mock import MockEstate, start_mock_server
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+health_script = os.path.join(script_folder, 'Sophos_Central_Health.py')
+health_config = os.path.join(script_folder, 'Sophos_Central_Health.config')
+# Runs Sophos_Central_Health.py and prints its peak memory when it finishes. resource is not on Windows
+# RUSAGE_CHILDREN is the largest finished child process, which is the largest shard process
+run_health_script = '''
+import atexit, runpy, sys
+try:
+    import resource
+except ImportError:
+    resource = None
+def print_peak_memory():
+    if resource is not None:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_shard_memory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        # macOS reports bytes, Linux reports KB
+        if sys.platform == 'darwin':
+            peak_memory = peak_memory // 1024
+            peak_shard_memory = peak_shard_memory // 1024
+        print(f"Peak_Memory_KB:{peak_memory}", file=sys.__stderr__)
+        print(f"Peak_Shard_Memory_KB:{peak_shard_memory}", file=sys.__stderr__)
+atexit.register(print_peak_memory)
+sys.argv = [sys.argv[1]]
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+
+def write_benchmark_config(mock_url, run_folder, config_settings):
+    config = configparser.ConfigParser()
+    config.read(health_config)
+    config['DEFAULT']['ClientID'] = 'benchmark'
+    config['DEFAULT']['ClientSecret'] = 'benchmark'
+    config['REPORT']['ReportName'] = 'Benchmark'
+    config['REPORT']['ReportFilePath'] = run_folder + os.sep
+    config['EXTRA_FIELDS']['Show_sse_menu'] = '0'
+    # Every run starts from nothing and the console only shows problems
+    config['PERFORMANCE']['Log_Level'] = 'WARNING'
+    config['PERFORMANCE']['Show_Progress'] = '0'
+    config['PERFORMANCE']['Bypass_Response_Cache'] = '1'
+    if not config.has_section('API'):
+        config.add_section('API')
+    config['API']['Token_URL'] = f"{mock_url}{'/api/v2/oauth2/token'}"
+    config['API']['Global_API_URL'] = mock_url
+    config['API']['Regional_API_URL'] = mock_url
+    for config_setting in config_settings:
+        config_key, config_value = config_setting.split('=', 1)
+        config_section, config_key = config_key.split('.', 1)
+        if config_section != 'DEFAULT' and not config.has_section(config_section):
+            config.add_section(config_section)
+        config[config_section][config_key] = config_value
+    with open(os.path.join(run_folder, 'Sophos_Central_Health.config'), 'w') as config_file:
+        config.write(config_file)
+    return config.getint('PERFORMANCE', 'Shard_Processes', fallback=1)
+
+
+def run_benchmark(id_type, arguments):
+    estate = MockEstate(id_type, arguments.tenants, arguments.endpoints, arguments.alerts, arguments.seed,
+                        arguments.latency, arguments.rate_429, arguments.retry_after)
+    mock_server = start_mock_server(estate)
+    try:
+        with tempfile.TemporaryDirectory() as run_folder:
+            shard_processes = write_benchmark_config(estate.url, run_folder, arguments.set)
+            start_time = time.perf_counter()
+            try:
+                health_run = subprocess.run([sys.executable, '-c', run_health_script, health_script], cwd=run_folder,
+                                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                                            timeout=arguments.timeout)
+                exit_code = health_run.returncode
+                health_stderr = health_run.stderr
+            except subprocess.TimeoutExpired:
+                # A run that never finishes is reported instead of holding up the benchmark
+                exit_code = None
+                health_stderr = ''
+            run_time = time.perf_counter() - start_time
+            peak_memory = 0
+            peak_shard_memory = 0
+            for stderr_line in health_stderr.splitlines():
+                if stderr_line.startswith('Peak_Memory_KB:'):
+                    peak_memory = int(stderr_line.split(':', 1)[1])
+                elif stderr_line.startswith('Peak_Shard_Memory_KB:'):
+                    # Without shards the only child processes are small helpers. A tenant is never sharded
+                    if shard_processes > 1 and id_type != 'tenant':
+                        peak_shard_memory = int(stderr_line.split(':', 1)[1])
+                elif stderr_line:
+                    print(stderr_line, file=sys.stderr)
+            # Count the machines in the finished reports to check the run worked
+            # Each report starts with the high and medium alert totals then the column names
+            machines_reported = 0
+            for report_name in glob.glob(os.path.join(run_folder, '*.csv')):
+                if not report_name.endswith('.partial.csv'):
+                    with open(report_name, encoding='utf-8', newline='') as report_file:
+                        machines_reported += max(0, sum(1 for _ in csv.reader(report_file)) - 3)
+    finally:
+        mock_server.shutdown()
+        mock_server.server_close()
+    return {'mode': id_type,
+            'sub_estates': len(estate.tenants),
+            'machines': len(estate.endpoint_index),
+            'machines_reported': machines_reported,
+            'seconds': run_time,
+            'requests': estate.requests,
+            'requests_429': estate.requests_429,
+            'peak_memory_mb': peak_memory / 1024,
+            'peak_shard_memory_mb': peak_shard_memory / 1024,
+            'shard_processes': shard_processes,
+            'exit_code': exit_code}
+
+
+def run_rate_limit_check(arguments):
+    # Each run has to finish with every machine in the report. Before the rate limiter was fixed they never finished
+    # The first is slowed by the config. The second is slowed to the lowest rate by too many requests answers
+    rate_limit_checks = (('Tenant_Requests_Per_Second 0.5', 0.0, ['PERFORMANCE.Tenant_Requests_Per_Second=0.5']),
+                         ('Half the requests answered 429', 0.5, ['PERFORMANCE.API_Max_Retries=20',
+                                                                  'PERFORMANCE.Tenant_Requests_Per_Second=1',
+                                                                  'PERFORMANCE.Region_Requests_Per_Second=1']))
+    checks_failed = 0
+    for check_name, rate_429, config_settings in rate_limit_checks:
+        check_arguments = copy.copy(arguments)
+        check_arguments.endpoints = 100
+        check_arguments.alerts = 10
+        check_arguments.rate_429 = rate_429
+        check_arguments.retry_after = 0
+        check_arguments.set = arguments.set + config_settings
+        if check_arguments.timeout is None:
+            check_arguments.timeout = 120
+        result = run_benchmark('tenant', check_arguments)
+        if result['exit_code'] is None:
+            check_result = f"FAILED - still running after {check_arguments.timeout} seconds"
+        elif result['exit_code'] != 0 or result['machines_reported'] != result['machines']:
+            check_result = f"FAILED - exit code {result['exit_code']}, {result['machines_reported']} machines reported"
+        else:
+            check_result = f"OK - {result['seconds']:.1f} seconds, {result['requests_429']} too many requests answers"
+        if check_result.startswith('FAILED'):
+            checks_failed += 1
+        print(f"{check_name:<34}{check_result}")
+    return checks_failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time Sophos_Central_Health.py against a local mock Sophos Central')
+    parser.add_argument('--modes', default='partner,organization,tenant',
+                        help='Comma separated list of partner, organization and tenant')
+    parser.add_argument('--tenants', type=int, default=5, help='Number of sub estates for partner and organization')
+    parser.add_argument('--endpoints', type=int, default=2000, help='Machines in each sub estate')
+    parser.add_argument('--alerts', type=int, default=200, help='Alerts in each sub estate')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--rate-429', type=float, default=0.0,
+                        help='Share of requests answered with 429 Too Many Requests. For example 0.05')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429')
+    parser.add_argument('--set', action='append', default=[], metavar='SECTION.Key=value',
+                        help='Change a setting in Sophos_Central_Health.config for the runs')
+    parser.add_argument('--timeout', type=float, help='Seconds before a run is stopped and reported as not finishing')
+    parser.add_argument('--rate-limit-check', action='store_true',
+                        help='Check that runs slowed below 1 request a second still finish, then stop')
+    arguments = parser.parse_args()
+    if arguments.rate_limit_check:
+        sys.exit(1 if run_rate_limit_check(arguments) else 0)
+    print(f"{'Mode':<14}{'Sub estates':>12}{'Machines':>10}{'Seconds':>10}{'Machines/s':>12}{'Requests':>10}"
+          f"{'Requests/s':>12}{'429s':>7}{'Peak MB':>10}{'Shard MB':>10}")
+    for id_type in arguments.modes.split(','):
+        result = run_benchmark(id_type.strip(), arguments)
+        print(f"{result['mode']:<14}{result['sub_estates']:>12}{result['machines']:>10}{result['seconds']:>10.2f}"
+              f"{result['machines'] / result['seconds']:>12.1f}{result['requests']:>10}"
+              f"{result['requests'] / result['seconds']:>12.1f}{result['requests_429']:>7}"
+              f"{result['peak_memory_mb']:>10.1f}{result['peak_shard_memory_mb']:>10.1f}")
+        if result['peak_shard_memory_mb'] > 0:
+            print(f"{' ' * 14}Shard MB is the largest of the {result['shard_processes']} shard processes. They run at "
+                  f"the same time so the total is up to "
+                  f"{result['peak_memory_mb'] + result['shard_processes'] * result['peak_shard_memory_mb']:.1f} MB")
+        if result['exit_code'] is None:
+            print(f"{' ' * 14}Sophos_Central_Health.py was stopped after {arguments.timeout} seconds")
+        elif result['exit_code'] != 0:
+            print(f"{' ' * 14}Sophos_Central_Health.py failed with exit code {result['exit_code']}")
+        elif result['machines_reported'] != result['machines']:
+            print(f"{' ' * 14}The reports have {result['machines_reported']} machines, not {result['machines']}")
+
+
+if __name__ == '__main__':
+    main()
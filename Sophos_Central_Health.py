@@ -20,12 +20,17 @@
 #
 # By: Michael Curtis and Robert Prechtel
 # Date: 29/5/2020
-# Version v2024.12
+# Version v2026.10
 # README: This script is an unsupported solution provided by Sophos Professional Services
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
 import csv
 import configparser
+# Import sys to intern the health states and to move the console output off stdout for JSON Lines
+import sys
 # Import OS to allow to check which OS the script is being run on
 import os
 # Import datetime modules
@@ -36,6 +41,32 @@ from datetime import timedelta
 import time
 # Import getpass for Client Secret
 import getpass
+# Import argparse for the command line options and re for the sub estate name pattern
+import argparse
+import re
+# Import json to store the alert lists in the partial reports
+import json
+# Import sqlite3 and zlib for the endpoint store used by incremental crawls
+import sqlite3
+import zlib
+# Import threading and concurrent.futures to check sub estates at the same time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# Import queue to pass pages of machines from the thread requesting them to the thread checking them
+import queue
+# Import subprocess and shutil to run the shard processes and merge what they write
+import subprocess
+import shutil
+# Import logging for the console output. Log_Level in the config file sets how much is shown
+import logging
+# Import bisect to put each request time in its latency bucket
+import bisect
+# pyarrow is only needed for the Parquet output. pip install pyarrow
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 # Allows colour to work in Microsoft PowerShell
 os.system("")
 
@@ -44,8 +75,6 @@ now = datetime.now()
 time_stamp = str(now.strftime("%d%m%Y_%H-%M-%S"))
 # This list will hold all the sub estates
 sub_estate_list = []
-# This list will hold all the computers for the report
-computer_list = []
 # Count the number of total machines across all sub estates
 total_machines = 0
 # Complete list of services. Used to remove columns when not required for the report
@@ -118,17 +147,40 @@ services_list = ['Sophos AutoUpdate Service',
                  'Update Scheduler',
                  'Sophos Linux AntiVirus',
                  ]
-# list of high alerts
-list_of_high_alerts = []
-# list of medium alerts
-list_of_medium_alerts = []
+# Number of high alerts found for the report. The alerts are only kept while their sub estate is checked
+high_alerts_found = 0
+# Number of medium alerts found for the report
+medium_alerts_found = 0
+# Returned for machines with no alerts
+no_machine_alerts = {'high': (), 'medium': ()}
+# The states used by thousands of machines. Each record uses these strings instead of its own copy from the JSON
+# Days since last seen for each lastSeenAt date. Machines seen on the same day share the number of days
+last_seen_days_by_date = {}
+# Alerts added for each combination of health states. Made by get_health_alerts
+health_alerts_by_state = {}
+interned_values = {value: sys.intern(value) for value in (
+    'good', 'suspicious', 'bad', 'unknown', 'investigate', 'running', 'stopped', 'missing', 'installed',
+    'notInstalled', 'installing', 'encrypted', 'notEncrypted', 'Unknown', 'computer', 'server', 'N/A', 'Yes',
+    'automatic', 'manual')}
 # Put the machine name here to break on this machine
 debug_machine = 'put debug machine here'
 # Put the machine name here to break on this machine
 debug_sub_estate = 'put debug sub estate here'
-# Time the script started. Used to renew token when required
-start_time = time.time()
+# Time the script started
 script_start_time = time.time()
+# Console output. DEBUG shows every machine and alert, INFO shows each sub estate and the progress line
+logger = logging.getLogger('Sophos_Central_Health')
+# Rate limiters shared by every request to a tenant or to a region
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+# One pooled keep-alive session per API host. For example api-eu01.central.sophos.com
+api_sessions = {}
+api_sessions_lock = threading.Lock()
+# The part of the URL path that names each API call in the request metrics
+api_call_names = (('/adaptive-attack-protection', 'aap'), ('/endpoints', 'endpoints'), ('/alerts', 'alerts'),
+                  ('/tenants', 'tenants'), ('/whoami', 'whoami'), ('/token', 'token'))
+# Request latency histogram buckets in seconds
+latency_buckets = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
 class bcolours:
     HEADER = '\033[95m'
@@ -141,6 +193,438 @@ class bcolours:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
+class RateLimiter:
+    # Token bucket that paces the requests to one tenant or one region. Shared by all the workers
+    # The rate is halved after a 429 and goes slowly back up to max_rate while requests work
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.min_rate = min(0.5, max_rate)
+        self.rate = max_rate
+        self.tokens = max_rate
+        self.updated = time.monotonic()
+        # Nothing is sent until this time after a Retry-After or an empty rate limit
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # The bucket always holds at least one request or a rate below 1 a second would never send anything
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    wait_time = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def slow_down(self, retry_counter, retry_delay=None):
+        # After too many requests or a failed connection. Waits longer after each retry if no delay is given
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            if retry_delay is None:
+                retry_delay = min(2 ** retry_counter, 60)
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_delay)
+
+    def update(self, response, retry_counter):
+        if response.status_code in (429, 503):
+            # Uses the Retry-After header when it is sent
+            self.slow_down(retry_counter, get_retry_after(response))
+            return
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            # Stops before the limit is reached if Sophos Central says how many requests are left
+            remaining = response.headers.get('X-RateLimit-Remaining', response.headers.get('RateLimit-Remaining'))
+            reset = response.headers.get('X-RateLimit-Reset', response.headers.get('RateLimit-Reset'))
+            if remaining is not None and reset is not None:
+                try:
+                    remaining = int(remaining)
+                    reset = float(reset)
+                except ValueError:
+                    return
+                # The reset can be a time or a number of seconds
+                if reset > 1000000000:
+                    reset = reset - time.time()
+                if remaining <= 0:
+                    self.paused_until = max(self.paused_until, time.monotonic() + reset)
+                elif reset > 0:
+                    # Spread the requests that are left over the time until the reset
+                    self.rate = min(self.rate, max(self.min_rate, remaining / reset))
+
+
+def get_retry_after(response):
+    # Retry-After is a number of seconds or a date
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_rate_limiters(url, headers):
+    # Every request waits for the region of the host and for the tenant, partner or organization it is for
+    rate_limit_keys = [('region', urlsplit(url).netloc, region_requests_per_second)]
+    tenant_id = get_request_tenant_id(headers)
+    if tenant_id is not None:
+        rate_limit_keys.append(('tenant', tenant_id, tenant_requests_per_second))
+    limiters = []
+    with rate_limiters_lock:
+        for rate_limit_type, rate_limit_key, max_rate in rate_limit_keys:
+            rate_limiter = rate_limiters.get((rate_limit_type, rate_limit_key))
+            if rate_limiter is None:
+                rate_limiter = RateLimiter(max_rate)
+                rate_limiters[(rate_limit_type, rate_limit_key)] = rate_limiter
+            limiters.append(rate_limiter)
+    return limiters
+
+
+def get_api_session(url):
+    # Finds the session for the host in the URL. Makes a new one the first time a host is used
+    url_parts = urlsplit(url)
+    api_host = f"{url_parts.scheme}://{url_parts.netloc}"
+    with api_sessions_lock:
+        session = api_sessions.get(api_host)
+        if session is None:
+            session = requests.Session()
+            # Keeps connection_pool_size connections open to the host so each request does not need a new TLS handshake
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connection_pool_size)
+            session.mount(f"{api_host}/", adapter)
+            api_sessions[api_host] = session
+    return session
+
+
+def api_request(method, url, headers=None, authorize=True, **kwargs):
+    # All API calls go through here so they use the pooled session for the host and share the rate limits
+    request_rate_limiters = get_rate_limiters(url, headers)
+    # The tenant limiter, if the request is for a tenant. The region limiter is always first
+    tenant_rate_limiters = request_rate_limiters[1:]
+    # Labels for the request metrics
+    api_call = get_api_call_name(url)
+    tenant_id = get_request_tenant_id(headers)
+    retry_counter = 0
+    token_renewed = False
+    while True:
+        wait_start = time.perf_counter()
+        for rate_limiter in request_rate_limiters:
+            rate_limiter.wait()
+        rate_limit_wait = time.perf_counter() - wait_start
+        # Each request gets its own headers with the current token. The headers passed in are never changed
+        request_headers = dict(headers or {})
+        if authorize:
+            access_token = token_manager.get_access_token()
+            request_headers['Authorization'] = f"Bearer {access_token}"
+        request_start = time.perf_counter()
+        try:
+            response = get_api_session(url).request(method, url, headers=request_headers, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            # A reset or timed out connection is tried again with the same back off as too many requests
+            if retry_counter >= api_max_retries:
+                raise
+            for rate_limiter in request_rate_limiters:
+                rate_limiter.slow_down(retry_counter)
+            retry_counter += 1
+            logger.warning(f" -> {type(error).__name__} from {urlsplit(url).netloc} -> "
+                           f"Slowing down and doing retry {retry_counter} of {api_max_retries}")
+            continue
+        run_metrics.add_request(api_call, tenant_id, url, response, time.perf_counter() - request_start,
+                                rate_limit_wait, retry_counter > 0 or token_renewed)
+        if response.status_code == 429 and tenant_rate_limiters:
+            # Too many requests to one tenant only slows that tenant. The other tenants in the region carry on
+            for rate_limiter in tenant_rate_limiters:
+                rate_limiter.update(response, retry_counter)
+        else:
+            for rate_limiter in request_rate_limiters:
+                rate_limiter.update(response, retry_counter)
+        # The token was not accepted. Get a new one and try once more
+        if response.status_code == 401 and authorize and not token_renewed:
+            token_manager.renew_access_token(access_token)
+            token_renewed = True
+            continue
+        # Only too many requests and service unavailable are tried again
+        if response.status_code not in (429, 503) or retry_counter >= api_max_retries:
+            return response
+        retry_counter += 1
+        logger.warning(f" -> {response.status_code} {response.reason} from {urlsplit(url).netloc} -> "
+                       f"Slowing down and doing retry {retry_counter} of {api_max_retries}")
+
+
+def api_get(url, headers):
+    return api_request('GET', url, headers=headers)
+
+
+def close_api_sessions():
+    # Closes the pooled connections at the end of the run
+    with api_sessions_lock:
+        for session in api_sessions.values():
+            session.close()
+        api_sessions.clear()
+
+
+def get_request_tenant_id(headers):
+    # The tenant, partner or organization a request is for. None for whoami and the token
+    if not headers:
+        return None
+    return headers.get('X-Tenant-ID', headers.get('X-Partner-ID', headers.get('X-Organization-ID')))
+
+
+def get_api_call_name(url):
+    # The API call a URL is for. Used to label the request metrics
+    path = urlsplit(url).path
+    for api_call_marker, api_call_name in api_call_names:
+        if api_call_marker in path:
+            return api_call_name
+    return path
+
+
+def prometheus_label(value):
+    # Label values have backslashes, quotes and new lines escaped
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RunMetrics:
+    # Times each phase of the run and counts every API request by sub estate and region. Shared by all the workers
+    # Written at the end of the run as JSON and as a Prometheus textfile so the slow sub estates and API calls can be found
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Sub estate ID -> name and API host
+        self.tenants = {}
+        # (phase, tenant ID, region) -> [calls, seconds]
+        self.phases = {}
+        # (API call, tenant ID, region) -> request counts, times, bytes and latency histogram
+        self.requests = {}
+
+    def set_tenant(self, tenant_id, tenant_name, url):
+        with self.lock:
+            self.tenants[tenant_id] = (tenant_name, urlsplit(url).netloc)
+
+    def add_phase_time(self, phase, tenant_id, seconds, url=None):
+        # The region is the API host of the URL, or of the sub estate if no URL is given
+        with self.lock:
+            if url is not None:
+                region = urlsplit(url).netloc
+            else:
+                region = self.tenants.get(tenant_id, ('', ''))[1]
+            phase_time = self.phases.setdefault((phase, tenant_id or '', region), [0, 0.0])
+            phase_time[0] += 1
+            phase_time[1] += seconds
+
+    def add_request(self, api_call, tenant_id, url, response, seconds, rate_limit_wait, retried):
+        request_body = response.request.body
+        if isinstance(request_body, str):
+            request_body = request_body.encode('utf-8')
+        with self.lock:
+            request_stats = self.get_request_stats((api_call, tenant_id or '', urlsplit(url).netloc))
+            request_stats['requests'] += 1
+            if retried:
+                request_stats['retries'] += 1
+            if response.status_code == 429:
+                request_stats['too_many_requests'] += 1
+            status_codes = request_stats['status_codes']
+            status_codes[response.status_code] = status_codes.get(response.status_code, 0) + 1
+            request_stats['seconds'] += seconds
+            request_stats['rate_limit_wait_seconds'] += rate_limit_wait
+            request_stats['bytes_sent'] += len(request_body or b'')
+            request_stats['bytes_received'] += len(response.content)
+            request_stats['latency_buckets'][bisect.bisect_left(latency_buckets, seconds)] += 1
+
+    def get_request_stats(self, request_key):
+        # Called with the lock held
+        request_stats = self.requests.get(request_key)
+        if request_stats is None:
+            request_stats = {'requests': 0, 'retries': 0, 'too_many_requests': 0, 'status_codes': {},
+                             'seconds': 0.0, 'rate_limit_wait_seconds': 0.0, 'bytes_sent': 0,
+                             'bytes_received': 0, 'latency_buckets': [0] * (len(latency_buckets) + 1)}
+            self.requests[request_key] = request_stats
+        return request_stats
+
+    def add_shard_metrics(self, shard_metrics):
+        # Adds the metrics from a shard process, as made by get_metrics, to this run
+        with self.lock:
+            for tenant_row in shard_metrics['tenants']:
+                self.tenants[tenant_row['tenant_id']] = (tenant_row['name'], tenant_row['region'])
+            for phase_row in shard_metrics['phases']:
+                phase_time = self.phases.setdefault((phase_row['phase'], phase_row['tenant_id'], phase_row['region']),
+                                                    [0, 0.0])
+                phase_time[0] += phase_row['calls']
+                phase_time[1] += phase_row['seconds']
+            for request_row in shard_metrics['requests']:
+                request_stats = self.get_request_stats((request_row['api_call'], request_row['tenant_id'],
+                                                        request_row['region']))
+                for stat_name in ('requests', 'retries', 'too_many_requests', 'seconds', 'rate_limit_wait_seconds',
+                                  'bytes_sent', 'bytes_received'):
+                    request_stats[stat_name] += request_row[stat_name]
+                status_codes = request_stats['status_codes']
+                for status_code, count in request_row['status_codes'].items():
+                    status_codes[int(status_code)] = status_codes.get(int(status_code), 0) + count
+                for bucket_index, count in enumerate(request_row['latency_buckets'].values()):
+                    request_stats['latency_buckets'][bucket_index] += count
+
+    def get_metrics(self, run_seconds, machines):
+        with self.lock:
+            phase_rows = [{'phase': phase, 'tenant_id': tenant_id, 'region': region, 'calls': calls,
+                           'seconds': round(seconds, 6)}
+                          for (phase, tenant_id, region), (calls, seconds) in sorted(self.phases.items())]
+            request_rows = []
+            for (api_call, tenant_id, region), request_stats in sorted(self.requests.items()):
+                request_row = {'api_call': api_call, 'tenant_id': tenant_id, 'region': region}
+                request_row.update(request_stats)
+                request_row['status_codes'] = {str(status_code): count for status_code, count
+                                               in sorted(request_stats['status_codes'].items())}
+                request_row['seconds'] = round(request_stats['seconds'], 6)
+                request_row['rate_limit_wait_seconds'] = round(request_stats['rate_limit_wait_seconds'], 6)
+                # The number of requests that took up to each bucket time. The last bucket is everything slower
+                request_row['latency_buckets'] = {
+                    str(bucket_time): count for bucket_time, count in
+                    zip(list(latency_buckets) + ['+Inf'], request_stats['latency_buckets'])}
+                request_rows.append(request_row)
+            tenant_rows = [{'tenant_id': tenant_id, 'name': tenant_name, 'region': region}
+                           for tenant_id, (tenant_name, region) in sorted(self.tenants.items())]
+        # Totals so the sub estates, regions and phases that take the most time are easy to see
+        totals = {'phase_seconds': {}, 'tenant_seconds': {}, 'region_seconds': {}}
+        for phase_row in phase_rows:
+            for total_name, total_key in (('phase_seconds', 'phase'), ('tenant_seconds', 'tenant_id'),
+                                          ('region_seconds', 'region')):
+                totals[total_name][phase_row[total_key]] = round(
+                    totals[total_name].get(phase_row[total_key], 0) + phase_row['seconds'], 6)
+        for total_name in ('requests', 'retries', 'too_many_requests', 'bytes_sent', 'bytes_received'):
+            totals[total_name] = sum(request_row[total_name] for request_row in request_rows)
+        return {'run': {'started_at': now.isoformat(), 'run_seconds': round(run_seconds, 3),
+                        'organization_id': organization_id, 'organization_type': organization_type,
+                        'machines': machines},
+                'totals': totals,
+                'tenants': tenant_rows,
+                'phases': phase_rows,
+                'requests': request_rows}
+
+    def write_json(self, json_path, run_seconds, machines):
+        with open(json_path, 'w', encoding='utf-8') as json_file:
+            json.dump(self.get_metrics(run_seconds, machines), json_file, indent=2)
+
+    def write_prometheus(self, prometheus_path, run_seconds, machines):
+        # Written in the text format read by the node_exporter textfile collector
+        metrics = self.get_metrics(run_seconds, machines)
+        metric_prefix = 'sophos_central_health_'
+        lines = [f"# HELP {metric_prefix}run_seconds Time the last run took",
+                 f"# TYPE {metric_prefix}run_seconds gauge",
+                 f"{metric_prefix}run_seconds {metrics['run']['run_seconds']}",
+                 f"# HELP {metric_prefix}machines Machines checked in the last run",
+                 f"# TYPE {metric_prefix}machines gauge",
+                 f"{metric_prefix}machines {machines}",
+                 f"# HELP {metric_prefix}last_run_timestamp_seconds Time the last run finished",
+                 f"# TYPE {metric_prefix}last_run_timestamp_seconds gauge",
+                 f"{metric_prefix}last_run_timestamp_seconds {round(time.time(), 3)}",
+                 f"# HELP {metric_prefix}tenant_info Name and API host of each sub estate",
+                 f"# TYPE {metric_prefix}tenant_info gauge"]
+        for tenant_row in metrics['tenants']:
+            lines.append(f"{metric_prefix}tenant_info{{tenant=\"{prometheus_label(tenant_row['tenant_id'])}\","
+                         f"name=\"{prometheus_label(tenant_row['name'])}\","
+                         f"region=\"{prometheus_label(tenant_row['region'])}\"}} 1")
+        lines.extend([f"# HELP {metric_prefix}phase_seconds Time spent in each phase of the run",
+                      f"# TYPE {metric_prefix}phase_seconds gauge"])
+        for phase_row in metrics['phases']:
+            lines.append(f"{metric_prefix}phase_seconds{{phase=\"{phase_row['phase']}\","
+                         f"tenant=\"{prometheus_label(phase_row['tenant_id'])}\","
+                         f"region=\"{prometheus_label(phase_row['region'])}\"}} {phase_row['seconds']}")
+        request_metrics = (('requests', 'API requests sent'),
+                           ('retries', 'API requests that were tried again'),
+                           ('too_many_requests', '429 Too Many Requests answers'),
+                           ('rate_limit_wait_seconds', 'Time waiting for the rate limits before sending requests'),
+                           ('bytes_sent', 'Bytes sent in the request bodies'),
+                           ('bytes_received', 'Bytes received in the response bodies'))
+        for metric_name, metric_help in request_metrics:
+            lines.extend([f"# HELP {metric_prefix}{metric_name} {metric_help}",
+                          f"# TYPE {metric_prefix}{metric_name} gauge"])
+            for request_row in metrics['requests']:
+                lines.append(f"{metric_prefix}{metric_name}{{{get_request_labels(request_row)}}} "
+                             f"{request_row[metric_name]}")
+        lines.extend([f"# HELP {metric_prefix}responses Responses by status code",
+                      f"# TYPE {metric_prefix}responses gauge"])
+        for request_row in metrics['requests']:
+            for status_code, count in request_row['status_codes'].items():
+                lines.append(f"{metric_prefix}responses{{{get_request_labels(request_row)},code=\"{status_code}\"}} "
+                             f"{count}")
+        lines.extend([f"# HELP {metric_prefix}request_duration_seconds Time each API request took",
+                      f"# TYPE {metric_prefix}request_duration_seconds histogram"])
+        for request_row in metrics['requests']:
+            request_labels = get_request_labels(request_row)
+            bucket_count = 0
+            # Prometheus buckets count every request up to the bucket time
+            for bucket_time, count in request_row['latency_buckets'].items():
+                bucket_count += count
+                lines.append(f"{metric_prefix}request_duration_seconds_bucket{{{request_labels},le=\"{bucket_time}\"}} "
+                             f"{bucket_count}")
+            lines.append(f"{metric_prefix}request_duration_seconds_sum{{{request_labels}}} {request_row['seconds']}")
+            lines.append(f"{metric_prefix}request_duration_seconds_count{{{request_labels}}} {request_row['requests']}")
+        # Written to a new file then renamed so the collector never reads half a file
+        with open(f"{prometheus_path}{'.tmp'}", 'w', encoding='utf-8') as prometheus_file:
+            prometheus_file.write('\n'.join(lines) + '\n')
+        os.replace(f"{prometheus_path}{'.tmp'}", prometheus_path)
+
+
+def get_request_labels(request_row):
+    return (f"api_call=\"{prometheus_label(request_row['api_call'])}\","
+            f"tenant=\"{prometheus_label(request_row['tenant_id'])}\","
+            f"region=\"{prometheus_label(request_row['region'])}\"")
+
+
+class ResponseCache:
+    # Keeps API responses that rarely change on disk. For example whoami and the list of sub estates
+    # Each response has its own time to live. The least recently used responses are removed when the cache is full
+    def __init__(self, cache_path, max_size, bypass):
+        self.max_size = max_size
+        # Bypass does not read the cache but still saves the new responses in it
+        self.bypass = bypass
+        self.connection = sqlite3.connect(cache_path, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses (cache_key TEXT PRIMARY KEY, '
+                                    'expires_at REAL NOT NULL, used_at REAL NOT NULL, size INTEGER NOT NULL, '
+                                    'response BLOB NOT NULL)')
+
+    def get(self, cache_key):
+        if self.bypass == 1:
+            return None
+        row = self.connection.execute('SELECT response FROM responses WHERE cache_key = ? AND expires_at > ?',
+                                      (cache_key, time.time())).fetchone()
+        if row is None:
+            return None
+        with self.connection:
+            self.connection.execute('UPDATE responses SET used_at = ? WHERE cache_key = ?', (time.time(), cache_key))
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, cache_key, response, time_to_live_minutes):
+        if time_to_live_minutes <= 0:
+            return
+        response = zlib.compress(json.dumps(response).encode('utf-8'))
+        now_time = time.time()
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                                    (cache_key, now_time + time_to_live_minutes * 60, now_time, len(response),
+                                     response))
+            self.connection.execute('DELETE FROM responses WHERE expires_at <= ?', (now_time,))
+            # Remove the least recently used responses until the cache fits in its maximum size
+            cache_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            for cache_key, size in self.connection.execute(
+                    'SELECT cache_key, size FROM responses ORDER BY used_at').fetchall():
+                if cache_size <= self.max_size:
+                    break
+                self.connection.execute('DELETE FROM responses WHERE cache_key = ?', (cache_key,))
+                cache_size -= size
+
+    def close(self):
+        self.connection.close()
+
+
 # Get Access Token - JWT in the documentation
 def get_bearer_token(client, secret, url):
     d = {
@@ -149,10 +633,45 @@ def get_bearer_token(client, secret, url):
         'client_secret': secret,
         'scope': 'token'
     }
-    request_token = requests.post(url, auth=(client, secret), data=d)
+    request_token = api_request('POST', url, authorize=False, auth=(client, secret), data=d)
+    if request_token.status_code != 200:
+        # The token is renewed during the run by whichever worker needs it. Stops that worker with a clear error
+        # instead of looking for a token in the error response
+        logger.error(f"Could not get an access token from {url}. Status Code - {request_token.status_code} "
+                     f"{request_token.reason}")
+        raise RuntimeError(f"Could not get an access token. Status Code - {request_token.status_code} "
+                           f"{request_token.reason}. Check the Client ID and Client Secret if this is 400 or 401")
     json_token = request_token.json()
-    headers = {'Authorization': f"Bearer {json_token['access_token']}"}
-    return headers
+    # expires_in is the number of seconds the token can be used for
+    return json_token['access_token'], json_token.get('expires_in', 3600)
+
+
+class TokenManager:
+    # Keeps the access token and gets a new one before it expires. Shared by all the workers
+    # Only one worker gets a new token. The others wait for it instead of asking for their own
+    def __init__(self, client, secret, url):
+        self.client = client
+        self.secret = secret
+        self.url = url
+        self.access_token = None
+        self.renew_at = 0
+        self.lock = threading.Lock()
+
+    def get_access_token(self):
+        with self.lock:
+            if self.access_token is None or time.monotonic() >= self.renew_at:
+                auth_start = time.perf_counter()
+                self.access_token, expires_in = get_bearer_token(self.client, self.secret, self.url)
+                run_metrics.add_phase_time('auth', None, time.perf_counter() - auth_start, self.url)
+                # Renew a tenth of the way before expiry, and no more than 5 minutes early
+                self.renew_at = time.monotonic() + expires_in - min(300, expires_in / 10)
+            return self.access_token
+
+    def renew_access_token(self, rejected_access_token):
+        # Called after a 401. If another worker has already got a new token that one is used
+        with self.lock:
+            if self.access_token == rejected_access_token:
+                self.renew_at = 0
 
 
 def get_whoami():
@@ -160,9 +679,22 @@ def get_whoami():
     # Partner = MSP
     # Organization = Sophos Central Enterprise Dashboard
     # The whoami URL
-    whoami_url = 'https://api.central.sophos.com/whoami/v1'
-    request_whoami = requests.get(whoami_url, headers=headers)
-    whoami = request_whoami.json()
+    whoami_url = f"{global_api_url}{'/whoami/v1'}"
+    whoami_start = time.perf_counter()
+    # The response is cached for each Client ID as it only changes if the API credentials are moved
+    whoami_cache_key = f"{'whoami/'}{global_api_url}{'/'}{client_id}"
+    whoami = None
+    if response_cache is not None:
+        whoami = response_cache.get(whoami_cache_key)
+    if whoami is None:
+        request_whoami = api_get(whoami_url, {})
+        if request_whoami.status_code != 200:
+            # Never cached, so the next run asks again once the credentials or Sophos Central are working
+            logger.error(f"whoami failed. Status Code - {request_whoami.status_code} {request_whoami.reason}")
+            sys.exit(1)
+        whoami = request_whoami.json()
+        if response_cache is not None:
+            response_cache.put(whoami_cache_key, whoami, whoami_cache_minutes)
     # MSP or Sophos Central Enterprise Dashboard
     # We don't use this variable in this script. It returns the organization type
     organization_type = whoami["idType"]
@@ -175,39 +707,114 @@ def get_whoami():
     organization_id = whoami["id"]
     # The region_url is used if Sophos Central is a tenant
     region_url = whoami.get('apiHosts', {}).get("dataRegion", None)
+    run_metrics.add_phase_time('whoami', organization_id, time.perf_counter() - whoami_start, whoami_url)
     return organization_id, organization_header, organization_type, region_url
-def get_all_sub_estates():
+def get_sub_estate_pages():
+    # Gets the list of sub estates. The first page says how many pages there are and the other pages are then
+    # requested at the same time. Yields the sub estates, last page first as before, as soon as each page arrives
     # Add X-Organization-ID to the headers dictionary
-    headers[organization_header] = organization_id
-    # URL to get the list of tenants
-    # Request all tenants
-    request_sub_estates = requests.get(
-        f"{'https://api.central.sophos.com/'}{organization_type}{'/v1/tenants?pageTotal=True'}", headers=headers)
+    sub_estate_headers = {organization_header: organization_id}
+    # Request the first page of tenants at the largest page size with the number of pages
+    page_start = time.perf_counter()
+    request_sub_estates = api_get(
+        f"{global_api_url}{'/'}{organization_type}{'/v1/tenants?pageTotal=true&pageSize=100'}", sub_estate_headers)
     # Convert to JSON
-    sub_estate_json = request_sub_estates.json()
+    first_page_json = request_sub_estates.json()
+    run_metrics.add_phase_time('tenant_listing', organization_id, time.perf_counter() - page_start, global_api_url)
     # Find the number of pages we will need to search to get all the sub estates
-    total_pages = sub_estate_json["pages"]["total"]
+    total_pages = first_page_json["pages"]["total"]
+    if progress_display is not None and 'items' in first_page_json["pages"]:
+        progress_display.set_sub_estates_total(first_page_json["pages"]["items"])
     # Set the keys you want in the list
     sub_estate_keys = ('id', 'name', 'dataRegion', 'showAs')
-    while total_pages != 0:
-        # Paged URL https://api.central.sophos.com/organization/v1/tenants?page=2 add total pages in a loop
-        request_sub_estates = requests.get(
-            f"{'https://api.central.sophos.com/'}{organization_type}{'/v1/tenants?page='}{total_pages}",
-            headers=headers)
-        sub_estate_json = request_sub_estates.json()
-        # Add the tenants to the sub estate list
-        for all_sub_estates in sub_estate_json["items"]:
-            # Make a temporary Dictionary to be added to the sub estate list
-            sub_estate_dictionary = {key: value for key, value in all_sub_estates.items() if key in sub_estate_keys}
-            sub_estate_list.append(sub_estate_dictionary)
-            print(f"Sub Estate - {sub_estate_dictionary['showAs']}. Sub Estate ID - {sub_estate_dictionary['id']}")
-        total_pages -= 1
-    # Remove X-Organization-ID from headers dictionary. We don't need this anymore
-    del headers[organization_header]
-    # Print list of sub estates
-    for index, sub_estate_name in enumerate(sub_estate_list):
-        print(index, "-", sub_estate_name)
+    # The first page is kept. The others are requested by up to Connection_Pool_Size workers, last page first
+    page_executor = None
+    page_futures = {}
+    if total_pages > 1:
+        page_executor = ThreadPoolExecutor(max_workers=min(connection_pool_size, total_pages - 1))
+        for page in range(total_pages, 1, -1):
+            page_futures[page] = page_executor.submit(get_sub_estate_page, page, sub_estate_headers)
+    try:
+        for page in range(total_pages, 0, -1):
+            if page == 1:
+                page_items = first_page_json["items"]
+            else:
+                # Only the time waiting for the page is counted. The sub estates already yielded may be being checked
+                page_start = time.perf_counter()
+                page_items = page_futures.pop(page).result()
+                run_metrics.add_phase_time('tenant_listing', organization_id, time.perf_counter() - page_start,
+                                           global_api_url)
+            for all_sub_estates in page_items:
+                # Make a temporary Dictionary to be added to the sub estate list
+                yield {key: value for key, value in all_sub_estates.items() if key in sub_estate_keys}
+    finally:
+        if page_executor is not None:
+            page_executor.shutdown()
+
+
+def get_sub_estate_page(page, sub_estate_headers):
+    # Paged URL https://api.central.sophos.com/organization/v1/tenants?pageSize=100&page=2
+    request_sub_estates = api_get(
+        f"{global_api_url}{'/'}{organization_type}{'/v1/tenants?pageSize=100&page='}{page}", sub_estate_headers)
+    return request_sub_estates.json()["items"]
+
+
+def get_sub_estates_by_id(tenant_ids):
+    # Gets only the sub estates given with --tenant-id instead of listing every sub estate
+    sub_estate_headers = {organization_header: organization_id}
+    sub_estate_keys = ('id', 'name', 'dataRegion', 'showAs')
+    sub_estates = []
+    tenant_listing_start = time.perf_counter()
+    for tenant_id in tenant_ids:
+        # For example https://api.central.sophos.com/partner/v1/tenants/{tenantId}
+        request_sub_estate = api_get(f"{global_api_url}{'/'}{organization_type}{'/v1/tenants/'}{tenant_id}",
+                                     sub_estate_headers)
+        if request_sub_estate.status_code != 200:
+            logger.warning(f"Sub estate not found - {tenant_id}. Status Code - {request_sub_estate.status_code}")
+            continue
+        sub_estates.append({key: value for key, value in request_sub_estate.json().items() if key in sub_estate_keys})
+    run_metrics.add_phase_time('tenant_listing', organization_id, time.perf_counter() - tenant_listing_start,
+                               global_api_url)
+    return sub_estates
+
+
+def is_selected_sub_estate(sub_estate):
+    # Checks the sub estate matches --tenant-name and --data-region
+    if tenant_name_pattern is not None and not (tenant_name_pattern.search(sub_estate['showAs'])
+                                                or tenant_name_pattern.search(sub_estate.get('name', ''))):
+        return False
+    return not selected_data_regions or sub_estate['dataRegion'] in selected_data_regions
+
+
+def get_all_sub_estates():
+    # Yields the sub estates to check in the order they go in the report. Each one is added to sub_estate_list first
+    # Without the menu the sub estates are yielded as each page of the list arrives, so they can be checked straight away
+    sub_estates_cache_key = f"{'tenants/'}{global_api_url}{'/'}{organization_type}{'/'}{organization_id}"
+    cached_sub_estates = None
+    if not selected_tenant_ids and response_cache is not None:
+        cached_sub_estates = response_cache.get(sub_estates_cache_key)
+    if selected_tenant_ids:
+        # A targeted run only asks for the sub estates it needs
+        sub_estates = get_sub_estates_by_id(selected_tenant_ids)
+    elif cached_sub_estates is not None:
+        # Use the list of sub estates from the last run if it has not expired
+        logger.warning(f"Using the list of sub estates cached in {response_cache_path}. Sub estates added in the last "
+                       f"{tenants_cache_minutes:g} minutes are not checked. Set Bypass_Response_Cache to 1 to get a "
+                       f"new list")
+        sub_estates = cached_sub_estates
+    else:
+        sub_estates = get_sub_estate_pages()
+    # Every sub estate listed, before the command line selection, so the whole list is cached
+    listed_sub_estates = []
     if show_sse_menu == 1:
+        # The menu needs the whole list before a sub estate can be chosen
+        for sub_estate_dictionary in sub_estates:
+            listed_sub_estates.append(sub_estate_dictionary)
+            if is_selected_sub_estate(sub_estate_dictionary):
+                sub_estate_list.append(sub_estate_dictionary)
+        # Print list of sub estates. Always shown when the menu is used as it is needed to choose a sub estate
+        for index, sub_estate_name in enumerate(sub_estate_list):
+            print(index, "-", sub_estate_name)
         # Choose the sub estate you want to audit
         choice = input("Which sub estate do you want to audit? Enter the number or A for all: ")
         if choice.lower() != 'a':
@@ -219,79 +826,557 @@ def get_all_sub_estates():
             sub_estate_list.clear()
             # Add the sub estate you want to audit back into the empty sub_estate_list
             sub_estate_list.append(temp)
-    print(f"Sub Estates Found: {(len(sub_estate_list))}")
+        if progress_display is not None:
+            progress_display.set_sub_estates_total(len(sub_estate_list))
+        logger.info(f"Sub Estates Found: {(len(sub_estate_list))}")
+        yield from list(sub_estate_list)
+    else:
+        for sub_estate_dictionary in sub_estates:
+            listed_sub_estates.append(sub_estate_dictionary)
+            if is_selected_sub_estate(sub_estate_dictionary):
+                logger.debug(f"{len(sub_estate_list)} - {sub_estate_dictionary}")
+                sub_estate_list.append(sub_estate_dictionary)
+                yield sub_estate_dictionary
+        if progress_display is not None:
+            progress_display.set_sub_estates_total(len(sub_estate_list))
+        logger.info(f"Sub Estates Found: {(len(sub_estate_list))}")
+    if not selected_tenant_ids and cached_sub_estates is None and response_cache is not None:
+        response_cache.put(sub_estates_cache_key, listed_sub_estates, tenants_cache_minutes)
 
 
-def get_all_computers(sub_estate_token, url, sub_estate_name, alerts_url):
-    global headers
-    global start_time
-    # Get all Computers from sub estates
-    # Add pageSize to url and the view of full
-    pagesize = 500
-    # Store the base URL before it is changed to get all the computers
-    # Comes in useful for other queries, for example AAP
-    base_url = url
-    url = f"{url}{'/endpoints?pageSize='}{pagesize}{'&view=full'}"
-    computers_url = url
-    # Loop while the page_count is not equal to 0. We have more computers to query
-    page_count = 1
-    # Count the machines in the sub estate
-    machines_in_sub_estate = 0
-    # Get all the alerts from the console
-    if include_alerts == 1:
-        get_all_alerts(sub_estate_token, alerts_url, sub_estate_name)
-    while page_count != 0:
-        # Script Runtime
-        time_since_start = time.time()
-        token_time = (time_since_start - start_time)
-        # Sub estate to be searched
-        # Add X-Tenant-ID to the headers dictionary
-        headers['X-Tenant-ID'] = sub_estate_token
-        # Should the token be refreshed. Check after 30 minutes
-        if token_time >= 1800:
-            # print(f"Old Header - {headers}")
-            headers = get_bearer_token(client_id, client_secret, token_url)
-            headers['X-Tenant-ID'] = sub_estate_token
-            # print(f"New Header - {headers}")
-            start_time = time.time()
-        # Request all Computers
-        # Counters to handle API request limits
-        retry_counter = 0
-        retry_delay = 5
-        retry_max = 10
-        request_computers = requests.get(computers_url, headers=headers)
-        while request_computers.status_code == 429:
-            request_computers = requests.get(computers_url, headers=headers)
-            print(f" -> Get_All_Computers GET (already found computers={machines_in_sub_estate}) "
-                  f"result: {request_computers.status_code}")
-            if request_computers.status_code == 200:
-                break
-            if request_computers.status_code != 429:
-                print(f" -> ERROR {request_computers.status_code} {request_computers.reason} -> ABORT")
-                error_occurred = True
+class ProgressDisplay:
+    # One line showing how far the report has got. Shown at most Progress_Updates_Per_Second times a second
+    # Written over itself on a console. Written as a new line each time when the output goes to a file
+    def __init__(self, updates_per_second, output_stream):
+        self.update_interval = 1 / updates_per_second
+        self.output_stream = output_stream
+        self.in_place = output_stream.isatty()
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.last_shown = 0
+        self.line_length = 0
+        self.sub_estates_total = 0
+        self.sub_estates_done = 0
+        self.machines_done = 0
+        self.pages_done = 0
+        # Machines in the sub estates that are finished. Used to guess the size of the sub estates not started
+        self.machines_in_done_sub_estates = 0
+        # The sub estates being checked. Sub estate ID -> [name, machines checked, machines expected or None]
+        self.sub_estates = {}
+
+    def set_sub_estates_total(self, sub_estates_total):
+        with self.lock:
+            self.sub_estates_total = sub_estates_total
+
+    def start_sub_estate(self, sub_estate_token, sub_estate_name):
+        with self.lock:
+            self.sub_estates[sub_estate_token] = [sub_estate_name, 0, None]
+
+    def set_expected_machines(self, sub_estate_token, expected_machines):
+        with self.lock:
+            if sub_estate_token in self.sub_estates:
+                self.sub_estates[sub_estate_token][2] = expected_machines
+
+    def add_page(self, sub_estate_token, machines):
+        with self.lock:
+            self.sub_estates[sub_estate_token][1] += machines
+            self.machines_done += machines
+            self.pages_done += 1
+        self.show()
+
+    def finish_sub_estate(self, sub_estate_token):
+        with self.lock:
+            sub_estate_name, machines, expected_machines = self.sub_estates.pop(sub_estate_token)
+            self.sub_estates_done += 1
+            self.machines_in_done_sub_estates += machines
+        self.show()
+
+    def get_seconds_left(self, run_time):
+        # Works out the machines left from the sub estates being checked and the average size of the finished ones
+        if self.machines_done == 0:
+            return None
+        machines_left = sum(max(0, expected_machines - machines) for sub_estate_name, machines, expected_machines
+                            in self.sub_estates.values() if expected_machines is not None)
+        sub_estates_not_started = self.sub_estates_total - self.sub_estates_done - len(self.sub_estates)
+        if sub_estates_not_started > 0:
+            if self.sub_estates_done == 0:
+                return None
+            machines_left += sub_estates_not_started * self.machines_in_done_sub_estates / self.sub_estates_done
+        return machines_left * run_time / self.machines_done
+
+    def show(self, force=False):
+        with self.lock:
+            now_time = time.time()
+            if not force and now_time - self.last_shown < self.update_interval:
                 return
-            # status_code == 429 - do retry after X seconds till max retry amount reached
-            retry_counter = retry_counter + 1
-            if retry_counter > retry_max:
-                print(
-                    f" -> ERROR {request_computers.status_code} {request_computers.reason} -> "
-                    f"Maximum retries ({retry_max}) reached. -> ABORT")
-                error_occurred = True
+            self.last_shown = now_time
+            run_time = max(now_time - self.start_time, 0.001)
+            seconds_left = self.get_seconds_left(run_time)
+            time_left = '--' if seconds_left is None else str(timedelta(seconds=int(seconds_left)))
+            sub_estate_counts = ' '.join(
+                f"| {sub_estate_name} {machines}/{'?' if expected_machines is None else expected_machines}"
+                for sub_estate_name, machines, expected_machines in list(self.sub_estates.values())[:3])
+            progress_line = (f"Sub estates {self.sub_estates_done}/{self.sub_estates_total} | "
+                             f"Machines {self.machines_done} | Pages {self.pages_done} "
+                             f"({self.pages_done / run_time:.1f}/s) | ETA {time_left} {sub_estate_counts}").rstrip()
+            if self.in_place:
+                self.output_stream.write(f"\r{progress_line.ljust(self.line_length)}")
+                self.line_length = len(progress_line)
+            else:
+                self.output_stream.write(f"{progress_line}\n")
+            self.output_stream.flush()
+
+    def clear(self):
+        # Removes the progress line so a log message can be printed in its place
+        with self.lock:
+            if self.in_place and self.line_length:
+                self.output_stream.write(f"\r{' ' * self.line_length}\r")
+                self.line_length = 0
+
+    def finish(self):
+        self.show(force=True)
+        if self.in_place:
+            with self.lock:
+                self.output_stream.write('\n')
+                self.line_length = 0
+
+
+class ConsoleHandler(logging.StreamHandler):
+    # Prints the log messages. The progress line is removed first so the two don't mix
+    def emit(self, record):
+        if progress_display is not None:
+            progress_display.clear()
+        super().emit(record)
+
+
+def prefetch_pages(pages, queue_size):
+    # Requests the next pages in the background while the current page is checked
+    # The queue holds at most queue_size pages so the requests never get too far ahead
+    page_queue = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    def put_page(item):
+        # Stops waiting for space in the queue if the pages are no longer wanted
+        while not stopped.is_set():
+            try:
+                page_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch_pages():
+        try:
+            for page in pages:
+                if not put_page(('page', page)):
+                    break
+            else:
+                put_page(('done', None))
+        except Exception as error:
+            put_page(('error', error))
+        finally:
+            pages.close()
+
+    threading.Thread(target=fetch_pages, daemon=True).start()
+    try:
+        while True:
+            item_type, item = page_queue.get()
+            if item_type == 'page':
+                yield item
+            elif item_type == 'error':
+                raise item
+            else:
                 return
-            print(
+    finally:
+        stopped.set()
+
+
+def get_computer_pages(sub_estate_token, url, sub_estate_name, query='pageSize=500&view=full', count_machines=True,
+                       page_from_key=None):
+    # Gets the computers in a sub estate a page at a time. Yields the status code, the computers on the page and the
+    # key of the next page, or None on the last page. page_from_key carries on from a page saved in the checkpoint
+    # If the sub estate can't be read the computers are None and there are no more pages
+    # Add pageSize to url and the view of full
+    url = f"{url}{'/endpoints?'}{query}"
+    computers_url = url
+    if page_from_key is not None:
+        computers_url = f"{url}{'&pageFromKey='}{page_from_key}"
+    # The progress line uses the number of machines in the sub estate to work out the time left
+    count_machines = count_machines and progress_display is not None
+    if count_machines:
+        computers_url = f"{computers_url}{'&pageTotal=true'}"
+    # Sub estate to be searched. api_request adds the token to each request
+    tenant_headers = {'X-Tenant-ID': sub_estate_token}
+    while True:
+        # Request all Computers. api_request slows down and tries again if there are too many requests
+        page_start = time.perf_counter()
+        request_computers = api_get(computers_url, tenant_headers)
+        run_metrics.add_phase_time('endpoint_pages', sub_estate_token, time.perf_counter() - page_start)
+        if request_computers.status_code == 429 or request_computers.status_code >= 500:
+            logger.error(
                 f" -> ERROR {request_computers.status_code} {request_computers.reason} -> "
-                f"Wait {retry_delay} seconds and do {retry_counter}. retry")
-            time.sleep(retry_delay)
+                f"Maximum retries ({api_max_retries}) reached. -> ABORT")
+            yield request_computers.status_code, None, None
+            return
         if request_computers.status_code == 400:
-            print(request_computers.status_code)
+            logger.warning(request_computers.status_code)
         if request_computers.status_code == 403:
-            print(f"No access to sub estate - {sub_estate_name}. Status Code - {request_computers.status_code}")
-            # Making a dictionary as we have no access to this sub estate
-            computer_dictionary = {'hostname': 'No access', 'Sub Estate': sub_estate_name}
-            computer_list.append(computer_dictionary)
-            break
+            logger.warning(f"No access to sub estate - {sub_estate_name}. Status Code - {request_computers.status_code}")
+            yield request_computers.status_code, None, None
+            return
         # Convert to JSON
         computers_json = request_computers.json()
+        if count_machines and 'items' in computers_json['pages']:
+            progress_display.set_expected_machines(sub_estate_token, computers_json['pages']['items'])
+            count_machines = False
+        # Check to see if you have more than one page of machines by checking if nextKey exists
+        # We need to check if we need to page through lots of computers
+        next_page = computers_json['pages'].get('nextKey')
+        yield request_computers.status_code, computers_json['items'], next_page
+        if next_page is not None:
+            # Change URL to get the next page of computers
+            # Example https://api-us01.central.sophos.com/endpoint/v1/endpoints?pageFromKey=<next-key>
+            computers_url = f"{url}{'&pageFromKey='}{next_page}"
+        else:
+            # If we don't get another nextKey stop looping
+            return
+
+
+def get_endpoint_state(computer):
+    # The last seen time then the health values compared to find out if a machine has changed since the last run
+    health = computer.get('health', {})
+    return '|'.join([computer.get('lastSeenAt', ''),
+                     str(health.get('overall', '')),
+                     str(health.get('threats', {}).get('status', '')),
+                     str(health.get('services', {}).get('status', ''))])
+
+
+class EndpointStore:
+    # Keeps the last copy of every machine so an incremental crawl only asks for the machines that changed
+    # Each worker thread has its own connection. WAL lets them read while another one writes
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.local = threading.local()
+        connection = self.get_connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS tenants '
+                               '(tenant_id TEXT PRIMARY KEY, full_crawl_at REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS endpoints '
+                               '(tenant_id TEXT NOT NULL, endpoint_id TEXT NOT NULL, position INTEGER, crawl_id TEXT, '
+                               'state TEXT NOT NULL, endpoint BLOB NOT NULL, PRIMARY KEY (tenant_id, endpoint_id))')
+            connection.execute('CREATE INDEX IF NOT EXISTS endpoints_position ON endpoints (tenant_id, position)')
+
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.store_path, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+        return connection
+
+    def needs_full_crawl(self, tenant_id):
+        row = self.get_connection().execute('SELECT full_crawl_at FROM tenants WHERE tenant_id = ?',
+                                            (tenant_id,)).fetchone()
+        return row is None or time.time() - row[0] >= full_crawl_hours * 3600
+
+    def get_endpoint_states(self, tenant_id):
+        return dict(self.get_connection().execute('SELECT endpoint_id, state FROM endpoints WHERE tenant_id = ?',
+                                                  (tenant_id,)))
+
+    def save_endpoints(self, tenant_id, computers, first_position=None, crawl_id=None):
+        # The machine is compressed as the full view of a machine is a few KB of JSON
+        rows = [(tenant_id, computer['id'],
+                 None if first_position is None else first_position + index, crawl_id,
+                 get_endpoint_state(computer), zlib.compress(json.dumps(computer).encode('utf-8')))
+                for index, computer in enumerate(computers)]
+        with self.get_connection() as connection:
+            connection.executemany('INSERT OR REPLACE INTO endpoints VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def update_last_seen(self, tenant_id, computers):
+        # The machines that only checked in since the last run. The stored copy gets the last seen time from the list
+        # of machines instead of the full view being requested again
+        connection = self.get_connection()
+        rows = []
+        for computer in computers:
+            row = connection.execute('SELECT endpoint FROM endpoints WHERE tenant_id = ? AND endpoint_id = ?',
+                                     (tenant_id, computer['id'])).fetchone()
+            endpoint = json.loads(zlib.decompress(row[0]))
+            if 'lastSeenAt' in computer:
+                endpoint['lastSeenAt'] = computer['lastSeenAt']
+            else:
+                endpoint.pop('lastSeenAt', None)
+            rows.append((get_endpoint_state(endpoint), zlib.compress(json.dumps(endpoint).encode('utf-8')),
+                         tenant_id, computer['id']))
+        with connection:
+            connection.executemany('UPDATE endpoints SET state = ?, endpoint = ? WHERE tenant_id = ? AND endpoint_id = ?',
+                                   rows)
+
+    def set_positions(self, tenant_id, endpoint_ids, crawl_id):
+        # Puts the machines in the order Sophos Central listed them and marks them as seen in this crawl
+        with self.get_connection() as connection:
+            connection.executemany('UPDATE endpoints SET position = ?, crawl_id = ? '
+                                   'WHERE tenant_id = ? AND endpoint_id = ?',
+                                   ((position, crawl_id, tenant_id, endpoint_id)
+                                    for position, endpoint_id in enumerate(endpoint_ids)))
+
+    def finish_crawl(self, tenant_id, crawl_id, full_crawl):
+        # Removes the machines that were not seen in this crawl. They have been deleted from Sophos Central
+        with self.get_connection() as connection:
+            connection.execute('DELETE FROM endpoints WHERE tenant_id = ? AND crawl_id IS NOT ?', (tenant_id, crawl_id))
+            if full_crawl:
+                connection.execute('INSERT OR REPLACE INTO tenants VALUES (?, ?)', (tenant_id, time.time()))
+
+    def get_computer_pages(self, tenant_id, page_size=500):
+        # Reads the machines back a page at a time in the order Sophos Central listed them
+        position = 0
+        while True:
+            rows = self.get_connection().execute(
+                'SELECT endpoint FROM endpoints WHERE tenant_id = ? AND position >= ? AND position < ? '
+                'ORDER BY position', (tenant_id, position, position + page_size)).fetchall()
+            if not rows:
+                return
+            yield [json.loads(zlib.decompress(row[0])) for row in rows]
+            position += page_size
+
+
+def get_incremental_computer_pages(sub_estate_token, url, sub_estate_name):
+    # Updates the endpoint store for the sub estate then yields the pages of computers from the store
+    crawl_id = time_stamp
+    if endpoint_store.needs_full_crawl(sub_estate_token):
+        yield from get_full_computer_pages(sub_estate_token, url, sub_estate_name, crawl_id)
+    else:
+        yield from get_changed_computer_pages(sub_estate_token, url, sub_estate_name, crawl_id)
+
+
+def get_full_computer_pages(sub_estate_token, url, sub_estate_name, crawl_id, count_machines=True):
+    # Every machine is requested and saved. Done the first time, again after Full_Crawl_Hours and when too many
+    # machines have changed
+    position = 0
+    # The pages are saved in the endpoint store as they arrive so a checkpoint can't carry on from a page key
+    for status_code, computers, next_page in get_computer_pages(sub_estate_token, url, sub_estate_name,
+                                                                count_machines=count_machines):
+        if computers is None:
+            yield status_code, computers, None
+            return
+        endpoint_store.save_endpoints(sub_estate_token, computers, position, crawl_id)
+        position += len(computers)
+        yield status_code, computers, None
+    endpoint_store.finish_crawl(sub_estate_token, crawl_id, full_crawl=True)
+
+
+def get_changed_computer_pages(sub_estate_token, url, sub_estate_name, crawl_id):
+    # List every machine with only the fields needed to see if it has changed. The endpoints API has no changed since
+    # filter and lastSeenAfter would miss machines that were removed from the sub estate
+    # A machine that only checked in gets its last seen time from this list. Only new machines and machines whose
+    # health has changed are requested in full
+    stored_states = endpoint_store.get_endpoint_states(sub_estate_token)
+    listed_endpoint_ids = []
+    changed_endpoint_ids = []
+    list_pages = 0
+    for status_code, computers, next_page in get_computer_pages(sub_estate_token, url, sub_estate_name,
+                                                                'pageSize=500&fields=id,lastSeenAt,health'):
+        if computers is None:
+            yield status_code, computers, None
+            return
+        list_pages += 1
+        last_seen_computers = []
+        for computer in computers:
+            listed_endpoint_ids.append(computer['id'])
+            stored_state = stored_states.get(computer['id'])
+            endpoint_state = get_endpoint_state(computer)
+            if stored_state is None or stored_state.split('|', 1)[1] != endpoint_state.split('|', 1)[1]:
+                changed_endpoint_ids.append(computer['id'])
+            elif stored_state != endpoint_state:
+                last_seen_computers.append(computer)
+        endpoint_store.update_last_seen(sub_estate_token, last_seen_computers)
+    del stored_states
+    if (len(changed_endpoint_ids) + 99) // 100 > list_pages:
+        # Asking for the changed machines 100 at a time would take more requests than asking for every machine
+        logger.info(f"Machines changed in {sub_estate_name} {len(changed_endpoint_ids)} of "
+                    f"{len(listed_endpoint_ids)}. Requesting every machine")
+        yield from get_full_computer_pages(sub_estate_token, url, sub_estate_name, crawl_id, count_machines=False)
+        return
+    # Get the full view of the machines that are new or have changed. 100 at a time
+    for first_changed in range(0, len(changed_endpoint_ids), 100):
+        endpoint_ids = ','.join(changed_endpoint_ids[first_changed:first_changed + 100])
+        for status_code, computers, next_page in get_computer_pages(sub_estate_token, url, sub_estate_name,
+                                                                    f"{'pageSize=100&view=full&ids='}{endpoint_ids}",
+                                                                    count_machines=False):
+            if computers is None:
+                yield status_code, computers, None
+                return
+            endpoint_store.save_endpoints(sub_estate_token, computers)
+    endpoint_store.set_positions(sub_estate_token, listed_endpoint_ids, crawl_id)
+    endpoint_store.finish_crawl(sub_estate_token, crawl_id, full_crawl=False)
+    logger.info(f"Incremental crawl of {sub_estate_name}. Machines changed {len(changed_endpoint_ids)} "
+                f"of {len(listed_endpoint_ids)}")
+    for computers in endpoint_store.get_computer_pages(sub_estate_token):
+        yield 200, computers, None
+
+
+class CheckpointStore:
+    # Saves how far the run has got so an interrupted run can carry on where it stopped with --resume
+    # Holds one run. The finished sub estates and the page key, partial report size and machines of the ones being
+    # checked. Sub estate workers and shard processes share the file. Each worker thread has its own connection
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        connection = self.get_connection()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS run (name TEXT PRIMARY KEY, value TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS sub_estates (tenant_id TEXT PRIMARY KEY, '
+                               'partial_report_path TEXT, next_key TEXT, partial_report_size INTEGER, '
+                               'machines INTEGER, max_high_alerts INTEGER, max_medium_alerts INTEGER, result TEXT, '
+                               'printed INTEGER NOT NULL DEFAULT 0)')
+
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.checkpoint_path, timeout=60, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    def start_run(self, run_time_stamp, run_report_file_path):
+        # A new run forgets the last one
+        connection = self.get_connection()
+        with connection:
+            connection.execute('DELETE FROM run')
+            connection.execute('DELETE FROM sub_estates')
+            connection.executemany('INSERT INTO run VALUES (?, ?)', [('time_stamp', run_time_stamp),
+                                                                     ('report_file_path', run_report_file_path)])
+
+    def get_run(self):
+        run_values = dict(self.get_connection().execute('SELECT name, value FROM run').fetchall())
+        if 'time_stamp' not in run_values:
+            return None
+        return run_values['time_stamp'], run_values['report_file_path']
+
+    def save_page(self, tenant_id, partial_report_path, next_key, partial_report_size, machines, max_high_alerts,
+                  max_medium_alerts):
+        connection = self.get_connection()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO sub_estates VALUES (?, ?, ?, ?, ?, ?, ?, NULL, 0)',
+                               (tenant_id, partial_report_path, next_key, partial_report_size, machines,
+                                max_high_alerts, max_medium_alerts))
+
+    def get_page(self, tenant_id):
+        # None if the sub estate has to be checked from the start. For example the partial report has gone
+        page = self.get_connection().execute(
+            'SELECT partial_report_path, next_key, partial_report_size, machines, max_high_alerts, max_medium_alerts '
+            'FROM sub_estates WHERE tenant_id = ? AND result IS NULL AND next_key IS NOT NULL',
+            (tenant_id,)).fetchone()
+        if page is None or not os.path.exists(page[0]) or os.path.getsize(page[0]) < page[2]:
+            return None
+        return page
+
+    def finish_sub_estate(self, tenant_id, sub_estate_result):
+        connection = self.get_connection()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO sub_estates (tenant_id, result) VALUES (?, ?)',
+                               (tenant_id, json.dumps(sub_estate_result)))
+
+    def get_result(self, tenant_id):
+        row = self.get_connection().execute('SELECT result FROM sub_estates WHERE tenant_id = ? AND result IS NOT NULL',
+                                            (tenant_id,)).fetchone()
+        return tuple(json.loads(row[0])) if row is not None else None
+
+    def set_printed(self, tenant_id):
+        connection = self.get_connection()
+        with connection:
+            connection.execute('UPDATE sub_estates SET printed = 1 WHERE tenant_id = ?', (tenant_id,))
+
+    def is_printed(self, tenant_id):
+        return self.get_connection().execute('SELECT 1 FROM sub_estates WHERE tenant_id = ? AND printed = 1',
+                                             (tenant_id,)).fetchone() is not None
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+
+    def remove(self):
+        # The run finished so there is nothing to resume
+        self.close()
+        for checkpoint_file in (self.checkpoint_path, f"{self.checkpoint_path}{'-wal'}", f"{self.checkpoint_path}{'-shm'}"):
+            if os.path.exists(checkpoint_file):
+                os.remove(checkpoint_file)
+
+
+def get_all_computers(sub_estate_token, url, sub_estate_name, alerts_url, partial_report_path):
+    # Get all Computers from sub estates
+    # Store the base URL. Comes in useful for other queries, for example AAP
+    base_url = url
+    tenant_headers = {'X-Tenant-ID': sub_estate_token}
+    run_metrics.set_tenant(sub_estate_token, sub_estate_name, url)
+    # A sub estate finished before an interrupted run is not checked again. One that was being checked carries on from
+    # the page after the last one saved in the checkpoint
+    resume_page = None
+    if checkpoint_store is not None:
+        finished_result = checkpoint_store.get_result(sub_estate_token)
+        if finished_result is not None:
+            logger.info(f'Already checked sub estate - {sub_estate_name}. Machines in sub estate {finished_result[0]}')
+            return finished_result
+        resume_page = checkpoint_store.get_page(sub_estate_token)
+    # Count the machines in the sub estate
+    machines_in_sub_estate = 0
+    # Most alert columns needed by a machine in this sub estate. The report columns are added when the report is printed
+    max_high_alerts = 0
+    max_medium_alerts = 0
+    page_from_key = None
+    partial_report_size = None
+    if resume_page is not None:
+        partial_report_path, page_from_key, partial_report_size, machines_in_sub_estate, max_high_alerts, \
+            max_medium_alerts = resume_page
+        logger.info(f'Carrying on with sub estate - {sub_estate_name} after {machines_in_sub_estate} machines')
+    # Set when Sophos Central stops answering. The sub estate is not marked as finished so --resume carries on with it
+    crawl_aborted = False
+    # Set when the alerts could not be checked. The rows have no alerts so no page is saved and --resume starts the
+    # sub estate again
+    alerts_failed = False
+    # The rows are written to the partial report after each page so memory does not grow with the number of machines
+    partial_report_file, partial_report_writer = open_partial_report(partial_report_path, partial_report_size)
+    if progress_display is not None:
+        progress_display.start_sub_estate(sub_estate_token, sub_estate_name)
+    # This list will hold the records of the computers for the page being checked
+    tenant_computer_list = []
+    # Each sub estate has its own AAP workers so one slow tenant does not hold up the AAP requests of another
+    aap_executor = None
+    if Show_AAP_Status == 1:
+        aap_executor = ThreadPoolExecutor(max_workers=aap_workers)
+    # Get all the alerts from the console while the machines are requested. tenant_alerts is freed when the sub estate
+    # is done
+    tenant_alerts = {}
+    tenant_medium_alert_count = 0
+    tenant_high_alert_count = 0
+    alerts_executor = None
+    alerts_future = None
+    if include_alerts == 1:
+        alerts_executor = ThreadPoolExecutor(max_workers=1)
+        alerts_future = alerts_executor.submit(get_all_alerts, sub_estate_token, alerts_url, sub_estate_name)
+    if incremental_crawl == 1:
+        # Only the machines that changed since the last run are requested. The rest come from the endpoint store
+        computer_pages = get_incremental_computer_pages(sub_estate_token, url, sub_estate_name)
+    else:
+        computer_pages = get_computer_pages(sub_estate_token, url, sub_estate_name, page_from_key=page_from_key)
+    if page_prefetch > 0:
+        # The next page is requested while this one is checked
+        computer_pages = prefetch_pages(computer_pages, page_prefetch)
+    for status_code, computers, next_page in computer_pages:
+        if computers is None:
+            if status_code == 403:
+                # Making a dictionary as we have no access to this sub estate
+                computer_dictionary = {'hostname': 'No access', 'Sub Estate': sub_estate_name}
+                tenant_computer_list.append(report_schema.make_record(computer_dictionary))
+            else:
+                crawl_aborted = True
+            break
         # Set the keys you want in the list
         computer_keys = ('id',
                          'hostname',
@@ -307,8 +1392,21 @@ def get_all_computers(sub_estate_token, url, sub_estate_name, alerts_url):
                          'majorVersion',
                          'type',
                          )
+        # Get the AAP state for the whole page at the same time before the rows are made
+        page_aap_status = {}
+        if Show_AAP_Status == 1:
+            page_aap_status = get_page_aap_status(computers, base_url, tenant_headers, aap_executor)
+        # Works out the last seen days and the Sophos Central GUI links for the whole page before the rows are made
+        page_last_seen_days, page_machine_links = get_page_columns(computers)
+        # The alerts are needed from here. Wait for them if they are still being requested
+        if alerts_future is not None:
+            tenant_alerts, tenant_medium_alert_count, tenant_high_alert_count = alerts_future.result()
+            alerts_future = None
+            if tenant_alerts is None:
+                alerts_failed = True
+                tenant_alerts = {}
         # Add the computers to the computers list
-        for all_computers in computers_json["items"]:
+        for page_index, all_computers in enumerate(computers):
             works = 0
             # Make a temporary Dictionary to be added to the sub estate list
             computer_dictionary = {key: value for key, value in all_computers.items() if key in computer_keys}
@@ -317,13 +1415,14 @@ def get_all_computers(sub_estate_token, url, sub_estate_name, alerts_url):
                 computer_dictionary['hostname'] = 'Unknown'
                 continue
             # If a machine fails, uncomment the line below to print machine names
-            print(f"Checking computer name: {bcolours.OKBLUE}{computer_dictionary['hostname']}{bcolours.ENDC} - {request_computers.status_code}")
+            if log_machines:
+                logger.debug(f"Checking computer name: {bcolours.OKBLUE}{computer_dictionary['hostname']}{bcolours.ENDC} - {status_code}")
             # This line allows you to debug on a certain computer. Add computer name
             if debug_machine == computer_dictionary['hostname']:
                 print('Add breakpoint here')
             # Sends the last seen date to get_days_since_last_seen and converts this to days
             if 'lastSeenAt' in computer_dictionary.keys():
-                computer_dictionary['Last_Seen'] = get_days_since_last_seen(computer_dictionary['lastSeenAt'])
+                computer_dictionary['Last_Seen'] = page_last_seen_days[page_index]
                 works = 1
             if works == 0:
                 # API is returning incomplete machine fields
@@ -332,7 +1431,7 @@ def get_all_computers(sub_estate_token, url, sub_estate_name, alerts_url):
                 if organization_type != "tenant":
                     computer_dictionary['Sub Estate'] = sub_estate_name
                 computer_dictionary['Machine_URL'] = 'N/A'
-                computer_list.append(computer_dictionary)
+                tenant_computer_list.append(report_schema.make_record(computer_dictionary))
                 continue
             if 'health' in computer_dictionary.keys():
                 if 'status' in computer_dictionary['health']['services']:
@@ -346,7 +1445,7 @@ def get_all_computers(sub_estate_token, url, sub_estate_name, alerts_url):
                             service_name = services['name']
                             computer_dictionary[service_name] = services['status']
                             if service_name == "SophosWebNetworkExtension":
-                                print('Add breakpoint here')
+                                logger.debug('Add breakpoint here')
                 else:
                     computer_dictionary['service_health'] = 'investigate'
                 if 'status' in computer_dictionary['health']['threats']:
@@ -427,13 +1526,9 @@ def get_all_computers(sub_estate_token, url, sub_estate_name, alerts_url):
                 if organization_type == "tenant":
                     # Provides direct link to the machines if the Sophos Central console is a tenant
                     # Also returns the id used in the Sophos Central GUI
-                    computer_dictionary['Machine_URL'], computer_dictionary['gui_id'] = \
-                        make_valid_client_id(computer_dictionary['type'],
-                                             computer_dictionary['id'])
+                    computer_dictionary['Machine_URL'], computer_dictionary['gui_id'] = page_machine_links[page_index]
                 else:
-                    computer_dictionary['Machine_URL'], computer_dictionary['gui_id'] = \
-                        make_valid_client_id(computer_dictionary['type'],
-                                             computer_dictionary['id'])
+                    computer_dictionary['Machine_URL'], computer_dictionary['gui_id'] = page_machine_links[page_index]
                     # Replace the URL as not helpful for Sophos Central Enterprise Dashboard or Partner
                     computer_dictionary['Machine_URL'] = 'N/A'
                     # Adds the sub estate name to the computer dictionary
@@ -444,7 +1539,7 @@ def get_all_computers(sub_estate_token, url, sub_estate_name, alerts_url):
                 computer_dictionary['macAddresses'] = all_computers['macAddresses']
             # Get AAP state
             if Show_AAP_Status == 1:
-                aap_active, aap_activated_by,aap_last_updated,aap_expires = get_aap_status(computer_dictionary['id'], base_url)
+                aap_active, aap_activated_by,aap_last_updated,aap_expires = page_aap_status[computer_dictionary['id']]
                 computer_dictionary['AAP_Active'] = aap_active
                 computer_dictionary['AAP_Activated_By'] = aap_activated_by
                 computer_dictionary['AAP_Last_Updated'] = aap_last_updated
@@ -453,95 +1548,28 @@ def get_all_computers(sub_estate_token, url, sub_estate_name, alerts_url):
             if include_alerts == 1:
             # print(f"Add Alerts to the report")
                 medium_alert_count, high_alert_count, list_of_computer_medium_alerts, list_of_computer_high_alerts = \
-                    get_machine_alerts(computer_dictionary['id'], computer_dictionary['hostname'], sub_estate_name)
-                alert_count = 0
-                # Finds the first column for high alerts. EDB and Single console have different number of columns
-                high_alert_start_column = report_column_order.index('tamperProtectionEnabled') + 2
-                for alert in list_of_computer_high_alerts:
-                    computer_dictionary[f"high_alerts_{alert_count}"] = alert
-                    # Checks to see if another alert column is needed
-                    if f'high_alerts_{alert_count}' not in report_column_order:
-                        # Adds the Alert to the column order list in the right place.
-                        # Starts at the column after Tamper Enabled
-                        report_column_order.insert(high_alert_start_column + alert_count, f"high_alerts_{alert_count}")
-                        # Adds the alert column name list in the right place. Starts at the column after Tamper Enabled
-                        report_column_names.insert(high_alert_start_column + alert_count,
-                                                   f"High Alert No. {alert_count + 1}")
-                    alert_count += 1
-                alert_count = 0
-                # Finds the first column for medium alerts. We don't know how many highs we will have
-                medium_alert_start_column = report_column_order.index('number_medium_alerts') + 1
-                for alert in list_of_computer_medium_alerts:
-                    computer_dictionary[f"medium_alerts_{alert_count}"] = alert
-                    # Checks to see if another alert column is needed
-                    if f'medium_alerts_{alert_count}' not in report_column_order:
-                        # Adds the Alert to the column order list in the right place. Starts at column 17
-                        report_column_order.insert(medium_alert_start_column + alert_count,
-                                                   f"medium_alerts_{alert_count}")
-                        # Adds the alert column name list in the right place. Starts at column 17
-                        report_column_names.insert(medium_alert_start_column + alert_count,
-                                                   f"Medium Alert No. {alert_count + 1}")
-                    alert_count += 1
-                # Adds the result of the get_machine_alerts to the computer_dictionary
-                # Making sure there a count of zero is not added to the number of alerts column
-                if high_alert_count != 0:
-                    computer_dictionary['number_high_alerts'] = high_alert_count
-                if medium_alert_count != 0:
-                    computer_dictionary['number_medium_alerts'] = medium_alert_count
+                    get_machine_alerts(computer_dictionary['id'], computer_dictionary['hostname'], sub_estate_name,
+                                       tenant_alerts)
                 # Check Health key is present to add extra Alerts
                 # These alerts are added by this script and not by Sophos Central
                 if 'health' in computer_dictionary:
                     # Adding details to the report where the Alert count is zero as the Health status is not good
                     # This has been caused by Event that did not trigger an Alert
+                    health_high_alerts, health_medium_alerts = get_health_alerts(
+                        computer_dictionary['health'], computer_dictionary['threats'],
+                        computer_dictionary['service_health'])
                     if high_alert_count == 0:
-                    # Bad, Good, Bad
-                        if 'good' != computer_dictionary['service_health']:
-                             high_alert_count += 1
-                             list_of_computer_high_alerts.append('Broken Service(s)')
-                     # Adding bad Threat to the high alert column as this is not an Alert
-                     # Bad, Bad, Good
-                        if 'bad' == computer_dictionary['threats']:
-                            high_alert_count += 1
-                            list_of_computer_high_alerts.append('Investigation Required')
-                     # Adding Bad, Good, Good to the report
-                        if 'bad' == computer_dictionary['health'] and computer_dictionary['threats'] == 'good' \
-                             and computer_dictionary['service_health'] == 'good':
-                            high_alert_count += 1
-                            list_of_computer_high_alerts.append('Investigation Required')
+                        high_alert_count += len(health_high_alerts)
+                        list_of_computer_high_alerts.extend(health_high_alerts)
                     if medium_alert_count == 0:
-                     # Adding Suspicious, Good, Good to the report
-                        if 'suspicious' == computer_dictionary['health'] and computer_dictionary['threats'] == 'good' \
-                                and computer_dictionary['service_health'] == 'good':
-                         medium_alert_count += 1
-                         list_of_computer_medium_alerts.append('Investigation Required')
-                alert_count = 0
-                # Finds the first column for high alerts. EDB and Single console have different number of columns
-                high_alert_start_column = report_column_order.index('tamperProtectionEnabled') + 2
-                for alert in list_of_computer_high_alerts:
-                    computer_dictionary[f"high_alerts_{alert_count}"] = alert
-                    # Checks to see if another alert column is needed
-                    if f'high_alerts_{alert_count}' not in report_column_order:
-                         # Adds the Alert to the column order list in the right place.
-                         # Starts at the column after Tamper Enabled
-                         report_column_order.insert(high_alert_start_column + alert_count, f"high_alerts_{alert_count}")
-                         # Adds the alert column name list in the right place. Starts at the column after Tamper Enabled
-                         report_column_names.insert(high_alert_start_column + alert_count,
-                                                    f"High Alert No. {alert_count + 1}")
-                    alert_count += 1
-                alert_count = 0
-                # Finds the first column for medium alerts. We don't know how many highs we will have
-                medium_alert_start_column = report_column_order.index('number_medium_alerts') + 1
-                for alert in list_of_computer_medium_alerts:
-                    computer_dictionary[f"medium_alerts_{alert_count}"] = alert
-                    # Checks to see if another alert column is needed
-                    if f'medium_alerts_{alert_count}' not in report_column_order:
-                    # Adds the Alert to the column order list in the right place. Starts at column 17
-                        report_column_order.insert(medium_alert_start_column + alert_count,
-                                                    f"medium_alerts_{alert_count}")
-                    # Adds the alert column name list in the right place. Starts at column 17
-                        report_column_names.insert(medium_alert_start_column + alert_count,
-                                                    f"Medium Alert No. {alert_count + 1}")
-                    alert_count += 1
+                        medium_alert_count += len(health_medium_alerts)
+                        list_of_computer_medium_alerts.extend(health_medium_alerts)
+                # The alert lists are written to the partial report. print_report makes them into alert columns
+                computer_dictionary['high_alerts'] = list_of_computer_high_alerts
+                computer_dictionary['medium_alerts'] = list_of_computer_medium_alerts
+                # Checks to see if more alert columns are needed. The columns are added when the report is printed
+                max_high_alerts = max(max_high_alerts, len(list_of_computer_high_alerts))
+                max_medium_alerts = max(max_medium_alerts, len(list_of_computer_medium_alerts))
                  # Adds the result of the get_machine_alerts to the computer_dictionary
                  # Making sure there are no 0 counts in the report
                 if high_alert_count != 0:
@@ -554,42 +1582,342 @@ def get_all_computers(sub_estate_token, url, sub_estate_name, alerts_url):
             if list_machines_with_issues_only == 0:
                 # If list_machines_in_group is empty add the machines
                 if list_machines_in_group[0] == "":
-                    computer_list.append(computer_dictionary)
+                    tenant_computer_list.append(report_schema.make_record(computer_dictionary))
                 elif 'group' in computer_dictionary and computer_dictionary['group'] in list_machines_in_group:
-                    computer_list.append(computer_dictionary)
+                    tenant_computer_list.append(report_schema.make_record(computer_dictionary))
             # Add machine if health is not good and listing only broken machine
             elif 'health' in computer_dictionary and computer_dictionary['health'] != 'good':
                 if list_machines_in_group[0] == "":
-                    computer_list.append(computer_dictionary)
+                    tenant_computer_list.append(report_schema.make_record(computer_dictionary))
                 elif 'group' in computer_dictionary and computer_dictionary['group'] in list_machines_in_group:
-                    computer_list.append(computer_dictionary)
+                    tenant_computer_list.append(report_schema.make_record(computer_dictionary))
             # Adding machines with no health and listing only broken machines
             elif 'health' not in computer_dictionary:
                 if list_machines_in_group == "":
-                    computer_list.append(computer_dictionary)
+                    tenant_computer_list.append(report_schema.make_record(computer_dictionary))
                 elif 'group' in computer_dictionary and computer_dictionary['group'] in list_machines_in_group:
-                    computer_list.append(computer_dictionary)
-        # Check to see if you have more than one page of machines by checking if nextKey exists
-        # We need to check if we need to page through lots of computers
-        if 'nextKey' in computers_json['pages']:
-            next_page = computers_json['pages']['nextKey']
-            # Change URL to get the next page of computers
-            # Example https://api-us01.central.sophos.com/endpoint/v1/endpoints?pageFromKey=<next-key>
-            computers_url = f"{url}{'&pageFromKey='}{next_page}"
-            # Add the number of machines on this page
-            machines_in_sub_estate += len(computers_json['items'])
-        else:
-            # Add the number of machines on the last page
-            machines_in_sub_estate += len(computers_json['items'])
-            # If we don't get another nextKey set page_count to 0 to stop looping
-            page_count = 0
+                    tenant_computer_list.append(report_schema.make_record(computer_dictionary))
+        # Write the rows for this page to the partial report and start the next page with an empty list
+        write_partial_report(partial_report_file, partial_report_writer, tenant_computer_list, sub_estate_token)
+        # Add the number of machines on this page
+        machines_in_sub_estate += len(computers)
+        if progress_display is not None:
+            progress_display.add_page(sub_estate_token, len(computers))
+        # The partial report is on disk so the checkpoint can say where to carry on from
+        if checkpoint_store is not None and not alerts_failed:
+            checkpoint_store.save_page(sub_estate_token, partial_report_path, next_page,
+                                       os.fstat(partial_report_file.fileno()).st_size, machines_in_sub_estate,
+                                       max_high_alerts, max_medium_alerts)
+    # The alert counts are still needed when the sub estate had no machines
+    if alerts_future is not None:
+        tenant_alerts, tenant_medium_alert_count, tenant_high_alert_count = alerts_future.result()
+        alerts_failed = tenant_alerts is None
+    if alerts_executor is not None:
+        alerts_executor.shutdown()
     if machines_in_sub_estate == 0:
         # Making a dictionary as no dictionary made due to no machines in the sub estate
         computer_dictionary = {'hostname': 'Empty sub estate', 'Sub Estate': sub_estate_name}
-        computer_list.append(computer_dictionary)
+        tenant_computer_list.append(report_schema.make_record(computer_dictionary))
+    # Write any rows not written yet. For example No access
+    write_partial_report(partial_report_file, partial_report_writer, tenant_computer_list, sub_estate_token)
+    partial_report_file.close()
+    if aap_executor is not None:
+        aap_executor.shutdown()
+    if progress_display is not None:
+        progress_display.finish_sub_estate(sub_estate_token)
     # print(url)
-    print(f'Checked sub estate - {sub_estate_name}. Machines in sub estate {machines_in_sub_estate}')
-    return machines_in_sub_estate
+    logger.info(f'Checked sub estate - {sub_estate_name}. Machines in sub estate {machines_in_sub_estate}')
+    sub_estate_result = (machines_in_sub_estate, partial_report_path, tenant_medium_alert_count,
+                         tenant_high_alert_count, max_high_alerts, max_medium_alerts)
+    if checkpoint_store is not None and not crawl_aborted and not alerts_failed:
+        checkpoint_store.finish_sub_estate(sub_estate_token, sub_estate_result)
+    return sub_estate_result
+
+
+def open_partial_report(partial_report_path, resume_size=None):
+    # The partial report holds the rows of one sub estate until print_report writes the report
+    # The alert lists go in the last two columns as the number of alert columns is not known yet
+    if resume_size is not None:
+        # Rows written after the last checkpoint are removed so they are not in the report twice
+        with open(partial_report_path, 'r+b') as partial_report_file:
+            partial_report_file.truncate(resume_size)
+        partial_report_file = open(partial_report_path, 'a', encoding='utf-8', newline='')
+    else:
+        partial_report_file = open(partial_report_path, 'w', encoding='utf-8', newline='')
+    partial_report_writer = csv.writer(partial_report_file)
+    return partial_report_file, partial_report_writer
+
+
+def write_partial_report(partial_report_file, partial_report_writer, tenant_computer_list, sub_estate_token):
+    write_start = time.perf_counter()
+    partial_report_writer.writerows(report_schema.make_partial_row(endpoint_record)
+                                    for endpoint_record in tenant_computer_list)
+    # The machines are sent to the JSON Lines output as soon as they are checked
+    # The No access and Empty sub estate rows are only for the report. They have no machine ID and are left out of the
+    # other outputs so they only have machines
+    machine_records = tenant_computer_list
+    if json_lines_writer is not None or parquet_report_writer is not None or history_database is not None:
+        machine_records = [endpoint_record for endpoint_record in tenant_computer_list
+                           if endpoint_record.get('id') is not None]
+    if json_lines_writer is not None:
+        json_lines_writer.write_records(machine_records)
+    if parquet_report_writer is not None:
+        parquet_report_writer.write_records(machine_records)
+    if history_database is not None:
+        history_database.add_endpoints(sub_estate_token, machine_records)
+    # Makes sure the rows are on disk if the script stops
+    partial_report_file.flush()
+    tenant_computer_list.clear()
+    run_metrics.add_phase_time('report_writing', sub_estate_token, time.perf_counter() - write_start)
+
+
+class JsonLinesWriter:
+    # Writes one JSON object for each machine to a file or stdout. Sub estate workers share it
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.lock = threading.Lock()
+
+    def write_records(self, endpoint_records):
+        json_lines = ''.join(f"{json.dumps(report_schema.make_json_object(endpoint_record))}\n"
+                             for endpoint_record in endpoint_records)
+        with self.lock:
+            self.output_file.write(json_lines)
+            self.output_file.flush()
+
+    def add_file(self, json_lines_path):
+        # Copies the machines written by a shard process
+        with self.lock, open(json_lines_path, encoding='utf-8') as json_lines_file:
+            shutil.copyfileobj(json_lines_file, self.output_file)
+            self.output_file.flush()
+
+
+def parquet_string(value):
+    return None if value == '' or value is None else str(value)
+
+
+def parquet_integer(value):
+    return None if value == '' or value is None else int(value)
+
+
+def parquet_boolean(value):
+    return None if value == '' or value is None else bool(value)
+
+
+def parquet_list(value):
+    return None if value == '' or value is None else [str(item) for item in value]
+
+
+class ParquetReportWriter:
+    # Writes the machines to a Parquet file. Each page of machines is its own row group
+    # so the whole report is never held in memory. The columns use the same names as the JSON Lines output
+    def __init__(self, parquet_path):
+        self.lock = threading.Lock()
+        # Columns with only a few different values are stored once with an index for each machine
+        dictionary_columns = {'Machine_URL', 'Sub Estate', 'Sub EstateID', 'type', 'provider', 'os', 'windows_build',
+                              'encryption', 'AAP_Active', 'AAP_Activated_By', 'health', 'threats', 'service_health',
+                              'group', 'coreAgent', 'v_coreAgent', 'interceptX', 'v_interceptX', 'deviceEncryption',
+                              'v_deviceEncryption', 'mtr', 'v_mtr', 'xdr', 'v_xdr', 'ztna', 'v_ztna'}
+        dictionary_columns.update(services_list)
+        column_types = {'Last_Seen': (pyarrow.int32(), parquet_integer),
+                        'number_high_alerts': (pyarrow.int32(), parquet_integer),
+                        'number_medium_alerts': (pyarrow.int32(), parquet_integer),
+                        'tamperProtectionEnabled': (pyarrow.bool_(), parquet_boolean),
+                        'capabilities': (pyarrow.list_(pyarrow.string()), parquet_list),
+                        'ipv4Addresses': (pyarrow.list_(pyarrow.string()), parquet_list),
+                        'macAddresses': (pyarrow.list_(pyarrow.string()), parquet_list),
+                        'high_alerts': (pyarrow.list_(pyarrow.string()), parquet_list),
+                        'medium_alerts': (pyarrow.list_(pyarrow.string()), parquet_list)}
+        # The type and the function that converts the value for each column in the record
+        self.columns = []
+        for column in report_schema.column_order + ['high_alerts', 'medium_alerts']:
+            if column in column_types:
+                self.columns.append(column_types[column])
+            elif column in dictionary_columns:
+                self.columns.append((pyarrow.dictionary(pyarrow.int32(), pyarrow.string()), parquet_string))
+            else:
+                self.columns.append((pyarrow.string(), parquet_string))
+        self.schema = pyarrow.schema([(column, column_type) for column, (column_type, convert_value) in
+                                      zip(report_schema.column_order + ['high_alerts', 'medium_alerts'],
+                                          self.columns)])
+        self.parquet_writer = pyarrow.parquet.ParquetWriter(parquet_path, self.schema)
+
+    def write_records(self, endpoint_records):
+        if not endpoint_records:
+            return
+        # Turns the page of records into columns
+        record_columns = zip(*(endpoint_record.values for endpoint_record in endpoint_records))
+        page_table = pyarrow.Table.from_arrays(
+            [pyarrow.array([convert_value(value) for value in values], type=column_type)
+             for (column_type, convert_value), values in zip(self.columns, record_columns)],
+            schema=self.schema)
+        with self.lock:
+            self.parquet_writer.write_table(page_table)
+
+    def add_file(self, parquet_path):
+        # Copies the row groups written by a shard process
+        parquet_file = pyarrow.parquet.ParquetFile(parquet_path)
+        with self.lock:
+            for row_group in range(parquet_file.num_row_groups):
+                self.parquet_writer.write_table(parquet_file.read_row_group(row_group))
+
+    def close(self):
+        self.parquet_writer.close()
+
+
+class HistoryDatabase:
+    # Keeps every run in a SQLite database so runs can be compared. For example how long a machine has been unhealthy
+    # Sub estate workers share one connection. Each page of machines is added in one transaction
+    def __init__(self, database_path, run_id=None):
+        # A shard process adds its machines to the run started by the main process
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database_path, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, started_at TEXT, '
+                                    'finished_at TEXT, organization_id TEXT, organization_type TEXT, '
+                                    'machines INTEGER)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS tenants (run_id INTEGER NOT NULL, tenant_id TEXT, '
+                                    'name TEXT, data_region TEXT, machines INTEGER, high_alerts INTEGER, '
+                                    'medium_alerts INTEGER, PRIMARY KEY (run_id, tenant_id))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS endpoints (run_id INTEGER NOT NULL, tenant_id TEXT, '
+                                    'endpoint_id TEXT, hostname TEXT, endpoint_type TEXT, os TEXT, health TEXT, '
+                                    'threats TEXT, service_health TEXT, last_seen_at TEXT, last_seen_days INTEGER, '
+                                    'high_alerts INTEGER, medium_alerts INTEGER, endpoint_group TEXT, details TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS alerts (run_id INTEGER NOT NULL, tenant_id TEXT, '
+                                    'endpoint_id TEXT, severity TEXT, description TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS endpoints_endpoint_id ON endpoints (endpoint_id, run_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS endpoints_tenant_id ON endpoints (tenant_id, run_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS endpoints_hostname ON endpoints (hostname, run_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS endpoints_health ON endpoints (health, run_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS alerts_endpoint_id ON alerts (endpoint_id, run_id)')
+            self.run_id = run_id
+            if run_id is None:
+                self.run_id = self.connection.execute(
+                    'INSERT INTO runs (started_at, organization_id, organization_type) VALUES (?, ?, ?)',
+                    (datetime.fromtimestamp(script_start_time).isoformat(timespec='seconds'), organization_id,
+                     organization_type)).lastrowid
+
+    def add_endpoints(self, sub_estate_token, endpoint_records):
+        endpoint_rows = []
+        alert_rows = []
+        for endpoint_record in endpoint_records:
+            endpoint_id = endpoint_record.get('id')
+            # Machines with missing fields can still have the health as it came from Sophos Central. Saved as JSON
+            endpoint_rows.append(tuple(
+                json.dumps(value) if isinstance(value, (dict, list)) else value for value in
+                (self.run_id, sub_estate_token, endpoint_id, endpoint_record.get('hostname'),
+                 endpoint_record.get('type'), endpoint_record.get('os'), endpoint_record.get('health'),
+                 endpoint_record.get('threats'), endpoint_record.get('service_health'),
+                 endpoint_record.get('lastSeenAt'), endpoint_record.get('Last_Seen'),
+                 endpoint_record.get('number_high_alerts'), endpoint_record.get('number_medium_alerts'),
+                 endpoint_record.get('group'), report_schema.make_json_object(endpoint_record))))
+            alert_rows.extend((self.run_id, sub_estate_token, endpoint_id, 'high', description)
+                              for description in endpoint_record.values[report_schema.high_alerts_column])
+            alert_rows.extend((self.run_id, sub_estate_token, endpoint_id, 'medium', description)
+                              for description in endpoint_record.values[report_schema.medium_alerts_column])
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO endpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                        endpoint_rows)
+            self.connection.executemany('INSERT INTO alerts VALUES (?, ?, ?, ?, ?)', alert_rows)
+
+    def add_sub_estate(self, sub_estate_token, sub_estate_name, data_region, machines, high_alerts, medium_alerts):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO tenants VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (self.run_id, sub_estate_token, sub_estate_name, data_region, machines,
+                                     high_alerts, medium_alerts))
+
+    def finish_run(self, machines):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE runs SET finished_at = ?, machines = ? WHERE run_id = ?',
+                                    (datetime.now().isoformat(timespec='seconds'), machines, self.run_id))
+        self.connection.close()
+
+    def close(self):
+        # Used by shard processes. The main process finishes the run
+        self.connection.close()
+
+
+def get_shard_path(shard_index, extension):
+    # Files written by a shard process for the main process. For example the shard results and JSON Lines
+    return f"{report_file_path}{time_stamp}{'_shard_'}{shard_index}{extension}"
+
+
+def run_shards(sub_estates):
+    # Splits the sub estates between Shard_Processes copies of this script. Each one checks every Nth sub estate with
+    # its own connections and its share of the region rate limit and writes its rows to the partial reports
+    # Returns the results in sub estate order so the reports are printed the same way as a run in one process
+    sub_estates = list(sub_estates)
+    shard_count = min(shard_processes, max(1, len(sub_estates)))
+    shard_run_path = get_shard_path('run', '.json')
+    with open(shard_run_path, 'w', encoding='utf-8') as shard_run_file:
+        json.dump({'time_stamp': time_stamp,
+                   'report_file_path': report_file_path,
+                   'shard_count': shard_count,
+                   'organization': [organization_id, organization_header, organization_type, region_url],
+                   'history_run_id': history_database.run_id if history_database is not None else None,
+                   'sub_estates': sub_estates}, shard_run_file)
+    # The shard processes use the secret already entered instead of asking for it again
+    shard_environment = dict(os.environ, SOPHOS_CENTRAL_CLIENT_SECRET=client_secret)
+    shard_commands = [[sys.executable, os.path.abspath(__file__), '-c', command_line.config,
+                       '--shard-run', shard_run_path, '--shard', str(shard_index)]
+                      for shard_index in range(shard_count)]
+    logger.info(f"Checking {len(sub_estates)} sub estates in {shard_count} shard processes")
+    shard_processes_running = [subprocess.Popen(shard_command, env=shard_environment, stdout=sys.stdout,
+                                                stdin=subprocess.DEVNULL)
+                               for shard_command in shard_commands]
+    failed_shards = [shard_index for shard_index, shard_process in enumerate(shard_processes_running)
+                     if shard_process.wait() != 0]
+    os.remove(shard_run_path)
+    if failed_shards:
+        logger.error(f"Shard processes {failed_shards} failed. The rows checked so far are in the .partial.csv files")
+        sys.exit(1)
+    # Merge what each shard wrote into the outputs of this process
+    sub_estate_results = [None] * len(sub_estates)
+    for shard_index in range(shard_count):
+        with open(get_shard_path(shard_index, '.json'), encoding='utf-8') as shard_results_file:
+            shard_results = json.load(shard_results_file)
+        for sub_estate_index, *sub_estate_result in shard_results['results']:
+            sub_estate_results[sub_estate_index] = tuple(sub_estate_result)
+        run_metrics.add_shard_metrics(shard_results['metrics'])
+        os.remove(get_shard_path(shard_index, '.json'))
+        if json_lines_writer is not None:
+            json_lines_writer.add_file(get_shard_path(shard_index, '.jsonl'))
+            os.remove(get_shard_path(shard_index, '.jsonl'))
+        if parquet_report_writer is not None:
+            parquet_report_writer.add_file(get_shard_path(shard_index, '.parquet'))
+            os.remove(get_shard_path(shard_index, '.parquet'))
+    return sub_estate_results
+
+
+def crawl_shard():
+    # Runs in a shard process. Checks every Nth sub estate and saves the results for the main process
+    shard_sub_estate_indexes = range(command_line.shard, len(sub_estate_list), shard_run['shard_count'])
+    shard_sub_estates = [sub_estate_list[sub_estate_index] for sub_estate_index in shard_sub_estate_indexes]
+    logger.info(f"Shard {command_line.shard} checking {len(shard_sub_estates)} sub estates")
+    if sub_estate_workers > 1:
+        with ThreadPoolExecutor(max_workers=sub_estate_workers) as shard_executor:
+            shard_results = list(shard_executor.map(crawl_sub_estate, shard_sub_estates))
+    else:
+        shard_results = list(map(crawl_sub_estate, shard_sub_estates))
+    machines = sum(shard_result[0] for shard_result in shard_results)
+    with open(get_shard_path(command_line.shard, '.json'), 'w', encoding='utf-8') as shard_results_file:
+        json.dump({'results': [[sub_estate_index] + list(shard_result) for sub_estate_index, shard_result
+                               in zip(shard_sub_estate_indexes, shard_results)],
+                   'metrics': run_metrics.get_metrics(time.time() - script_start_time, machines)},
+                  shard_results_file)
+    return machines
+
+
+def is_sub_estate_finished(sub_estate_token):
+    # False if Sophos Central stopped answering before every machine in the sub estate was checked
+    return checkpoint_store is None or checkpoint_store.get_result(sub_estate_token) is not None
+
+
+def get_partial_report_path(sub_estate_token):
+    # Named by the sub estate ID, not its place in the list, so a resumed run with a different list of sub estates never
+    # writes over the rows of another sub estate
+    return f"{report_file_path}{time_stamp}{'_sub_estate_'}{sub_estate_token}{'.partial.csv'}"
 
 
 def get_days_since_last_seen(report_date):
@@ -602,6 +1930,50 @@ def get_days_since_last_seen(report_date):
     days = (today - convert_last_seen_to_a_date).days
     return days
 
+def get_page_columns(computers):
+    # Works out the values for a whole page of machines. Each list is in the same order as the page
+    page_last_seen_days = []
+    for computer in computers:
+        last_seen_at = computer.get('lastSeenAt')
+        if last_seen_at is None:
+            page_last_seen_days.append(None)
+            continue
+        # Machines seen on the same day have the same number of days. Only the first machine on each day is converted
+        last_seen_day = last_seen_at[:10]
+        days = last_seen_days_by_date.get(last_seen_day)
+        if days is None:
+            days = last_seen_days_by_date[last_seen_day] = get_days_since_last_seen(last_seen_at)
+        page_last_seen_days.append(days)
+    page_machine_links = [make_valid_client_id(computer['type'], computer['id']) if 'type' in computer else None
+                          for computer in computers]
+    return page_last_seen_days, page_machine_links
+
+
+def get_health_alerts(health, threats, service_health):
+    # The alerts added by this script when the health is not good. Looked up by the three health states
+    health_alerts = health_alerts_by_state.get((health, threats, service_health))
+    if health_alerts is not None:
+        return health_alerts
+    health_high_alerts = []
+    health_medium_alerts = []
+    # Bad, Good, Bad
+    if 'good' != service_health:
+        health_high_alerts.append('Broken Service(s)')
+    # Adding bad Threat to the high alert column as this is not an Alert
+    # Bad, Bad, Good
+    if 'bad' == threats:
+        health_high_alerts.append('Investigation Required')
+    # Adding Bad, Good, Good to the report
+    if 'bad' == health and threats == 'good' and service_health == 'good':
+        health_high_alerts.append('Investigation Required')
+    # Adding Suspicious, Good, Good to the report
+    if 'suspicious' == health and threats == 'good' and service_health == 'good':
+        health_medium_alerts.append('Investigation Required')
+    health_alerts = health_alerts_by_state[(health, threats, service_health)] = (tuple(health_high_alerts),
+                                                                                 tuple(health_medium_alerts))
+    return health_alerts
+
+
 def make_valid_client_id(os, machine_id):
     # Characters to be removed
     # https://central.sophos.com/manage/server/devices/servers/b10cc611-7805-7419-e9f0-46947a4ab60e/summary
@@ -609,9 +1981,15 @@ def make_valid_client_id(os, machine_id):
     server_url = 'https://central.sophos.com/manage/server/devices/servers/'
     endpoint_url = 'https://central.sophos.com/manage/endpoint/devices/computers/'
     # Remove the - from the id
-    remove_characters_from_id = ['-']
-    for remove_each_character in remove_characters_from_id:
-        machine_id = machine_id.replace(remove_each_character, '')
+    machine_id = machine_id.replace('-', '')
+    if len(machine_id) == 32:
+        # Swaps each pair of characters and puts the - back in the same places as the slower code below
+        new_machine_id = ''.join(map(str.__add__, machine_id[1::2], machine_id[0::2]))
+        new_machine_id = (f"{new_machine_id[:8]}-{new_machine_id[8:12]}-{new_machine_id[12:16]}-"
+                          f"{new_machine_id[16:20]}-{new_machine_id[20:]}")
+        if os == 'computer':
+            return endpoint_url + new_machine_id, new_machine_id
+        return server_url + new_machine_id, new_machine_id
     new_machine_id = list(machine_id)
     # Rotates the characters
     new_machine_id[::2], new_machine_id[1::2] = new_machine_id[1::2], new_machine_id[::2]
@@ -625,17 +2003,82 @@ def make_valid_client_id(os, machine_id):
     return machine_url, new_machine_id
 
 
-def read_config():
+def parse_arguments():
+    # Every option is optional. With none the script runs the same way as before using Sophos_Central_Health.config
+    parser = argparse.ArgumentParser(description='Health report for every machine in Sophos Central')
+    parser.add_argument('-c', '--config', default='Sophos_Central_Health.config',
+                        help='Config file to use. Default Sophos_Central_Health.config')
+    parser.add_argument('--tenant-id', action='append', default=[],
+                        help='Sub estate ID to check. Can be used more than once or comma separated. '
+                             'Only these sub estates are requested instead of listing them all')
+    parser.add_argument('--tenant-name', help='Only check sub estates with a name matching this regular expression')
+    parser.add_argument('--data-region', action='append', default=[],
+                        help='Only check sub estates in this data region. For example eu01. Can be used more than once '
+                             'or comma separated')
+    parser.add_argument('-o', '--output-dir', help='Folder for the reports. Replaces ReportFilePath')
+    parser.add_argument('--no-menu', action='store_true',
+                        help='Do not show the sub estate menu. Used for scheduled runs. Choosing sub estates with '
+                             'the options above also turns the menu off')
+    parser.add_argument('--resume', action='store_true',
+                        help='Carry on with the last run if it was interrupted. Sub estates already checked are not '
+                             'checked again. Use the same options as the run being resumed')
+    parser.add_argument('--shards', type=int, help='Number of processes to split the sub estates between. '
+                                                   'Replaces Shard_Processes')
+    # Used by the main process to start the shard processes
+    parser.add_argument('--shard-run', help=argparse.SUPPRESS)
+    parser.add_argument('--shard', type=int, default=0, help=argparse.SUPPRESS)
+    command_line = parser.parse_args()
+    command_line.tenant_id = [tenant_id.strip() for tenant_ids in command_line.tenant_id
+                              for tenant_id in tenant_ids.split(',') if tenant_id.strip()]
+    command_line.data_region = [data_region.strip() for data_regions in command_line.data_region
+                                for data_region in data_regions.split(',') if data_region.strip()]
+    if command_line.tenant_name is not None:
+        try:
+            command_line.tenant_name = re.compile(command_line.tenant_name)
+        except re.error as error:
+            parser.error(f"--tenant-name is not a valid regular expression. {error}")
+    return command_line
+
+
+def read_config(command_line):
     config = configparser.ConfigParser()
-    config.read('Sophos_Central_Health.config')
+    if not config.read(command_line.config):
+        sys.exit(f"Config file not found - {command_line.config}")
     # config.read('Sophos_Central_Health.config')
     config.sections()
     client_id = config['DEFAULT']['ClientID']
     client_secret = config['DEFAULT']['ClientSecret']
+    # The Sophos Central URLs. Only changed to test against a local stand in like Sophos_Central_Mock.py
+    token_url = config.get('API', 'Token_URL', fallback='https://id.sophos.com/api/v2/oauth2/token')
+    global_api_url = config.get('API', 'Global_API_URL', fallback='https://api.central.sophos.com').rstrip('/')
+    regional_api_url = config.get('API', 'Regional_API_URL',
+                                  fallback='https://api-{dataRegion}.central.sophos.com').rstrip('/')
+    # Scheduled runs can put the secret in an environment variable instead of typing it
+    if client_secret == '':
+        client_secret = os.environ.get('SOPHOS_CENTRAL_CLIENT_SECRET', '')
     if client_secret == '':
         client_secret = getpass.getpass(prompt='Enter Client Secret: ', stream=None)
     report_name = config['REPORT']['ReportName']
     report_file_path = config['REPORT']['ReportFilePath']
+    if command_line.output_dir is not None:
+        os.makedirs(command_line.output_dir, exist_ok=True)
+        # Always ends with a / or \
+        report_file_path = os.path.join(command_line.output_dir, '')
+    # Leave blank for no JSON Lines output. - writes to stdout
+    json_lines_output = config.get('REPORT', 'JSON_Lines_Output', fallback='')
+    # Leave blank for no Parquet output
+    parquet_output = config.get('REPORT', 'Parquet_Output', fallback='')
+    # Leave blank for no history database
+    history_database_path = config.get('REPORT', 'History_Database', fallback='')
+    # Leave blank for no run metrics
+    metrics_json_path = config.get('REPORT', 'Metrics_JSON', fallback='')
+    metrics_prometheus_path = config.get('REPORT', 'Metrics_Prometheus', fallback='')
+    log_level = config.get('PERFORMANCE', 'Log_Level', fallback='INFO').upper()
+    if log_level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+        sys.exit(f"Log_Level in the PERFORMANCE section of the config file must be DEBUG, INFO, WARNING, ERROR or "
+                 f"CRITICAL - {log_level}")
+    show_progress = config.getint('PERFORMANCE', 'Show_Progress', fallback=1)
+    progress_updates_per_second = max(0.1, config.getfloat('PERFORMANCE', 'Progress_Updates_Per_Second', fallback=2))
     mac_address = config.getint('EXTRA_FIELDS', 'MAC_Address')
     versions = config.getint('EXTRA_FIELDS', 'Versions')
     windows_build_version = config.getint('EXTRA_FIELDS', 'Windows_Build_Version')
@@ -646,9 +2089,40 @@ def read_config():
     include_sse_id = config.getint('EXTRA_FIELDS', 'Include_Sub_EstateID')
     list_machines_with_issues_only = config.getint('EXTRA_FIELDS', 'List_Machines_With_Issues_Only')
     show_sse_menu = config.getint('EXTRA_FIELDS', 'Show_sse_menu')
+    # The menu waits for someone to choose a sub estate so it is not shown when they are chosen on the command line
+    if command_line.no_menu or command_line.tenant_id or command_line.tenant_name is not None or \
+            command_line.data_region:
+        show_sse_menu = 0
     list_machines_in_group = config['EXTRA_FIELDS']['List_Machines_In_Group']
     list_machines_in_group = list_machines_in_group.split(',')
     Show_AAP_Status = config.getint('EXTRA_FIELDS', 'Show_AAP_Status')
+    # Older config files don't have the PERFORMANCE section. Fall back to checking one sub estate at a time
+    sub_estate_workers = max(1, config.getint('PERFORMANCE', 'Sub_Estate_Workers', fallback=1))
+    connection_pool_size = max(1, config.getint('PERFORMANCE', 'Connection_Pool_Size', fallback=10))
+    aap_workers = max(1, config.getint('PERFORMANCE', 'AAP_Workers', fallback=8))
+    tenant_requests_per_second = max(0.1, config.getfloat('PERFORMANCE', 'Tenant_Requests_Per_Second', fallback=10))
+    region_requests_per_second = max(0.1, config.getfloat('PERFORMANCE', 'Region_Requests_Per_Second', fallback=50))
+    api_max_retries = max(0, config.getint('PERFORMANCE', 'API_Max_Retries', fallback=10))
+    page_prefetch = max(0, config.getint('PERFORMANCE', 'Page_Prefetch', fallback=2))
+    report_writer_queue = max(0, config.getint('PERFORMANCE', 'Report_Writer_Queue', fallback=2))
+    report_buffer_size = max(1, config.getint('PERFORMANCE', 'Report_Buffer_KB', fallback=1024)) * 1024
+    incremental_crawl = config.getint('PERFORMANCE', 'Incremental_Crawl', fallback=0)
+    endpoint_store_path = config.get('PERFORMANCE', 'Endpoint_Store', fallback='Sophos_Central_Health.store')
+    full_crawl_hours = config.getfloat('PERFORMANCE', 'Full_Crawl_Hours', fallback=24)
+    response_cache_path = config.get('PERFORMANCE', 'Response_Cache', fallback='Sophos_Central_Health.cache')
+    response_cache_size = config.getint('PERFORMANCE', 'Response_Cache_Size_MB', fallback=20) * 1024 * 1024
+    bypass_response_cache = config.getint('PERFORMANCE', 'Bypass_Response_Cache', fallback=0)
+    # Off unless set, so a config file without them never makes a cache file
+    whoami_cache_minutes = config.getfloat('PERFORMANCE', 'Whoami_Cache_Minutes', fallback=0)
+    # Off unless set. A cached list would leave out a sub estate added since it was cached
+    tenants_cache_minutes = config.getfloat('PERFORMANCE', 'Tenants_Cache_Minutes', fallback=0)
+    shard_processes = max(1, config.getint('PERFORMANCE', 'Shard_Processes', fallback=1))
+    # Leave blank for no checkpoint
+    checkpoint_path = config.get('PERFORMANCE', 'Checkpoint_File', fallback='Sophos_Central_Health.checkpoint')
+    if command_line.resume and checkpoint_path == '':
+        sys.exit('--resume needs Checkpoint_File in the PERFORMANCE section of the config file')
+    if command_line.shards is not None:
+        shard_processes = max(1, command_line.shards)
     # Checks if the last character of the file path contains a \ or / if not add one
     if report_file_path[-1].isalpha():
         if os.name != "posix":
@@ -656,7 +2130,13 @@ def read_config():
         else:
             report_file_path = report_file_path + "/"
     return (client_id, client_secret, report_name, report_file_path, mac_address, versions, windows_build_version,
-            cloud_servers, exclude_alerts, full_services_list, split_edb_reports, include_sse_id, list_machines_with_issues_only,show_sse_menu, list_machines_in_group,Show_AAP_Status)
+            cloud_servers, exclude_alerts, full_services_list, split_edb_reports, include_sse_id, list_machines_with_issues_only,show_sse_menu, list_machines_in_group,Show_AAP_Status,
+            sub_estate_workers, connection_pool_size, aap_workers, tenant_requests_per_second, region_requests_per_second,
+            api_max_retries, page_prefetch, incremental_crawl, endpoint_store_path, full_crawl_hours,
+            response_cache_path, response_cache_size, bypass_response_cache, whoami_cache_minutes,
+            tenants_cache_minutes, json_lines_output, parquet_output, history_database_path, log_level, show_progress,
+            progress_updates_per_second, token_url, global_api_url, regional_api_url, metrics_json_path,
+            metrics_prometheus_path, shard_processes, checkpoint_path, report_writer_queue, report_buffer_size)
 
 
 def report_field_names():
@@ -887,10 +2367,119 @@ def report_field_names():
     return report_column_names, report_column_order
 
 
-def get_aap_status(computer_id, url):
+class EndpointRecord:
+    # One machine in the report. The values are in the report_schema column order with the alert lists at the end
+    # __slots__ stops each record having its own dictionary. Only the fields in the report are kept
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, column):
+        # Returns None if the column is empty or not in the report
+        index = report_schema.column_index.get(column)
+        if index is None or self.values[index] == '':
+            return None
+        return self.values[index]
+
+
+class ReportSchema:
+    # The report columns. Built once from the config file before any sub estate is checked
+    # The alert columns are added by print_report when the most alerts on one machine is known
+    def __init__(self, report_column_names, report_column_order, unused_columns):
+        report_columns = [(column_name, column) for column_name, column in zip(report_column_names, report_column_order)
+                          if column not in unused_columns]
+        self.column_names = [column_name for column_name, column in report_columns]
+        self.column_order = [column for column_name, column in report_columns]
+        # Finds the position of a column without searching the list. The partial report has the alert lists at the end
+        self.column_index = {column: index for index, column in
+                             enumerate(self.column_order + ['high_alerts', 'medium_alerts'])}
+        self.high_alerts_column = self.column_index['high_alerts']
+        self.medium_alerts_column = self.column_index['medium_alerts']
+        # The alert columns go after the number of alerts columns. There are no alert columns if alerts are not included
+        if 'number_high_alerts' in self.column_index:
+            self.high_alert_start_column = self.column_index['number_high_alerts'] + 1
+            self.medium_alert_start_column = self.column_index['number_medium_alerts'] + 1
+        else:
+            self.high_alert_start_column = self.medium_alert_start_column = len(self.column_order)
+        # Column names for each number of alert columns. Most sub estate reports have the same number
+        self.column_names_by_alerts = {}
+
+    def make_record(self, computer_dictionary):
+        # Puts each value in its column. Keys that are not in the report are left out
+        values = [''] * len(self.column_index)
+        column_index = self.column_index
+        for column, value in computer_dictionary.items():
+            index = column_index.get(column)
+            if index is not None:
+                if value.__class__ is str:
+                    value = interned_values.get(value, value)
+                values[index] = value
+        values[self.high_alerts_column] = tuple(values[self.high_alerts_column] or ())
+        values[self.medium_alerts_column] = tuple(values[self.medium_alerts_column] or ())
+        return EndpointRecord(tuple(values))
+
+    def make_partial_row(self, endpoint_record):
+        # The alert lists are saved as JSON so they can be read back when the report is printed
+        row = list(endpoint_record.values)
+        row[self.high_alerts_column] = json.dumps(row[self.high_alerts_column])
+        row[self.medium_alerts_column] = json.dumps(row[self.medium_alerts_column])
+        return row
+
+    def make_json_object(self, endpoint_record):
+        # Keeps the types from Sophos Central. For example Last_Seen is a number and ipv4Addresses is a list
+        # Empty columns are null and the alerts are nested instead of being in their own columns
+        values = endpoint_record.values
+        json_object = {column: None if values[index] == '' else values[index]
+                       for index, column in enumerate(self.column_order)}
+        json_object['alerts'] = {'high': list(values[self.high_alerts_column]),
+                                 'medium': list(values[self.medium_alerts_column])}
+        return json_object
+
+    def get_column_names(self, max_high_alerts, max_medium_alerts):
+        column_names = self.column_names_by_alerts.get((max_high_alerts, max_medium_alerts))
+        if column_names is None:
+            column_names = self.column_names_by_alerts[(max_high_alerts, max_medium_alerts)] = (
+                self.column_names[:self.high_alert_start_column] +
+                [f"High Alert No. {alert_count + 1}" for alert_count in range(max_high_alerts)] +
+                self.column_names[self.high_alert_start_column:self.medium_alert_start_column] +
+                [f"Medium Alert No. {alert_count + 1}" for alert_count in range(max_medium_alerts)] +
+                self.column_names[self.medium_alert_start_column:])
+        return column_names
+
+    def make_report_row(self, partial_row, max_high_alerts, max_medium_alerts):
+        # Moves the alert lists from the end of a partial report row into their alert columns
+        high_alerts = json.loads(partial_row[self.high_alerts_column])
+        medium_alerts = json.loads(partial_row[self.medium_alerts_column])
+        return (partial_row[:self.high_alert_start_column] + high_alerts +
+                [''] * (max_high_alerts - len(high_alerts)) +
+                partial_row[self.high_alert_start_column:self.medium_alert_start_column] + medium_alerts +
+                [''] * (max_medium_alerts - len(medium_alerts)) +
+                partial_row[self.medium_alert_start_column:self.high_alerts_column])
+
+
+def get_page_aap_status(computers, url, tenant_headers, aap_executor):
+    # Gets the AAP state for every machine on a page of computers. AAP_Workers limits the requests in flight
+    # Only machines that will be added to the report are checked
+    computer_ids = [computer['id'] for computer in computers if 'hostname' in computer and 'lastSeenAt' in computer]
+    aap_start = time.perf_counter()
+    aap_results = aap_executor.map(lambda computer_id: get_aap_status(computer_id, url, tenant_headers),
+                                   computer_ids)
+    page_aap_status = dict(zip(computer_ids, aap_results))
+    run_metrics.add_phase_time('aap', tenant_headers['X-Tenant-ID'], time.perf_counter() - aap_start)
+    return page_aap_status
+
+
+def get_aap_status(computer_id, url, tenant_headers):
     # https://api-{dataRegion}.central.sophos.com/endpoint/v1/endpoints/{endpointId}/adaptive-attack-protection
     aap_url = f"{url}{'/endpoints/'}{computer_id}{'/adaptive-attack-protection'}"
-    request_aap_status = requests.get(aap_url, headers=headers)
+    # api_request slows every AAP worker for the tenant down if there are too many requests
+    request_aap_status = api_get(aap_url, tenant_headers)
+    if request_aap_status.status_code == 429 or request_aap_status.status_code >= 500:
+        # Too many requests after every retry or a Sophos Central error. This is not the same as no AAP support
+        logger.warning(f"AAP status could not be checked for {computer_id}. Status Code - "
+                       f"{request_aap_status.status_code} {request_aap_status.reason}")
+        return "AAP check failed", "", "", ""
     # Convert to JSON
     aap_json = request_aap_status.json()
     # The endpoint might not be new enough to support this API call. Makes sure value is present
@@ -917,34 +2506,28 @@ def get_aap_status(computer_id, url):
         aap_expires = ""
         aap_active = "AAP API not supported"
     return aap_active, aap_activated_by,aap_last_updated,aap_expires
-def get_machine_alerts(computer_id, hostname, sub_estate_name):
-    # Makes two lists of store the alert descriptions
-    list_of_computer_medium_alerts = []
-    list_of_computer_high_alerts = []
+def get_machine_alerts(computer_id, hostname, sub_estate_name, tenant_alerts):
     # This line allows you to debug on a certain computer. Add the debug machine at the top
     if hostname == debug_machine:
         print(f'Put breakpoint here - Debug Machine - {hostname}')
-    # Sets the alert count to zero
-    medium_alert_count = 0
-    high_alert_count = 0
-    # Checks the computer_id in the list_of_medium_alerts to see if the machine has an alert
-    for machine_id in list_of_medium_alerts:
-        if machine_id['managedAgent'] == computer_id:
-            medium_alert_count += 1
-            list_of_computer_medium_alerts.append(machine_id['description'])
-    # Checks the computer_id in the list_of_high_alerts to see if the machine has an alert
-    for machine_id in list_of_high_alerts:
-        if machine_id['managedAgent'] == computer_id:
-            high_alert_count += 1
-            list_of_computer_high_alerts.append(machine_id['description'])
-    if medium_alert_count != 0 or high_alert_count !=0:
-        print(
-            f'Finding alerts for machine:{bcolours.OKGREEN}{hostname}{bcolours.ENDC} - {computer_id} in {bcolours.OKBLUE}{sub_estate_name}. {bcolours.FAIL}High Alerts Found -  '
-            f'{high_alert_count}. {bcolours.WARNING}Medium Alerts Found -  {medium_alert_count}{bcolours.ENDC}')
-    else:
-        print(
-        f'Finding alerts for machine:{hostname} - {computer_id} in {sub_estate_name}. High Alerts Found -  '
-        f'{high_alert_count}. Medium Alerts Found -  {medium_alert_count}')
+    # Looks up the machine in the alert index made by get_all_alerts
+    machine_alerts = tenant_alerts.get(computer_id, no_machine_alerts)
+    # Makes two lists of store the alert descriptions
+    list_of_computer_medium_alerts = [alert['description'] for alert in machine_alerts['medium']]
+    list_of_computer_high_alerts = [alert['description'] for alert in machine_alerts['high']]
+    # Counts the alerts
+    medium_alert_count = len(list_of_computer_medium_alerts)
+    high_alert_count = len(list_of_computer_high_alerts)
+    # The message is only made when every machine is being shown
+    if log_machines:
+        if medium_alert_count != 0 or high_alert_count !=0:
+            logger.debug(
+                f'Finding alerts for machine:{bcolours.OKGREEN}{hostname}{bcolours.ENDC} - {computer_id} in {bcolours.OKBLUE}{sub_estate_name}. {bcolours.FAIL}High Alerts Found -  '
+                f'{high_alert_count}. {bcolours.WARNING}Medium Alerts Found -  {medium_alert_count}{bcolours.ENDC}')
+        else:
+            logger.debug(
+                f'Finding alerts for machine:{hostname} - {computer_id} in {sub_estate_name}. High Alerts Found -  '
+                f'{high_alert_count}. Medium Alerts Found -  {medium_alert_count}')
     # This line allows you to debug on a certain computer. Add computer name
     if hostname == debug_machine:
         print(f'Put breakpoint here - Debug Machine - {debug_machine}')
@@ -953,14 +2536,19 @@ def get_machine_alerts(computer_id, hostname, sub_estate_name):
 
 
 def get_all_alerts(tenant_token, url, sub_estate_name):
-    print(f"Getting all the alerts from {sub_estate_name}")
-    # Get all the alerts from the console
+    logger.info(f"Getting all the alerts from {sub_estate_name}")
+    alerts_start = time.perf_counter()
+    # Get all the high and medium alerts from the console. Sophos Central filters out the other severities
     # Loop while the page_count is not equal to 0. We have more computers to query
     page_count = 1
     # Debug - Put the sub estate name you want to debug in the line below
     if sub_estate_name == debug_sub_estate:
         print(f'Put breakpoint here - sub estate - {sub_estate_name}')
     alert_search_url = url
+    # The alerts for this sub estate indexed by the managedAgent id then severity. Sub estate workers never share this
+    tenant_alerts = {}
+    tenant_medium_alert_count = 0
+    tenant_high_alert_count = 0
     # Set the keys we need from the alert
     alert_keys = (
         'id',
@@ -973,16 +2561,23 @@ def get_all_alerts(tenant_token, url, sub_estate_name):
         'managedAgent',
     )
     while page_count != 0:
-        # Tenant to be searched
-        tenant_id = tenant_token
-        # Add X-Tenant-ID to the headers dictionary
-        headers['X-Tenant-ID'] = tenant_id
+        # Tenant to be searched. api_request adds the token to each request
+        tenant_headers = {'X-Tenant-ID': tenant_token}
         # Request all Computers
-        request_computers = requests.get(alert_search_url, headers=headers)
-        # Convert to JSON
-        alerts_json = request_computers.json()
+        request_computers = api_get(alert_search_url, tenant_headers)
         if request_computers.status_code == 403:
             break
+        if request_computers.status_code != 200:
+            # Too many requests after every retry or a Sophos Central error. The report has no alerts for the sub estate
+            # rather than only some of them. None tells get_all_computers the alerts are missing
+            logger.error(f"Alerts could not be checked for {sub_estate_name}. Status Code - "
+                         f"{request_computers.status_code} {request_computers.reason}")
+            tenant_alerts = None
+            tenant_medium_alert_count = 0
+            tenant_high_alert_count = 0
+            break
+        # Convert to JSON
+        alerts_json = request_computers.json()
         # Debug - Put the sub estate name you want to debug in the line below
         if sub_estate_name == debug_sub_estate:
             print(f'Put breakpoint here - sub estate - {sub_estate_name}')
@@ -996,7 +2591,10 @@ def get_all_alerts(tenant_token, url, sub_estate_name):
                     alerts_dictionary['managedAgent'] = alerts_dictionary['managedAgent']['id']
                 else:
                     alerts_dictionary['managedAgent'] = 'Console'
-                list_of_high_alerts.append(alerts_dictionary)
+                # Adds the alert to the high bucket for the machine
+                tenant_alerts.setdefault(alerts_dictionary['managedAgent'], {'high': [], 'medium': []})['high'].append(
+                    alerts_dictionary)
+                tenant_high_alert_count += 1
             if alerts['severity'] == 'medium':
                 # Get the Endpoint ID and reconfigure the alerts_dictionary
                 # Check to see if the alert has an ID
@@ -1004,10 +2602,14 @@ def get_all_alerts(tenant_token, url, sub_estate_name):
                     alerts_dictionary['managedAgent'] = alerts_dictionary['managedAgent']['id']
                 else:
                     alerts_dictionary['managedAgent'] = 'Console'
-                list_of_medium_alerts.append(alerts_dictionary)
-                print(
-                    f"Alert {bcolours.FAIL}{alerts['description']}{bcolours.ENDC} found. Event type - {bcolours.FAIL}{alerts['type']}{bcolours.ENDC}."
-                    f"Type - {bcolours.FAIL}{alerts['category']}{bcolours.ENDC}. Alert date - {bcolours.OKBLUE}{alerts['raisedAt']}{bcolours.ENDC}.")
+                # Adds the alert to the medium bucket for the machine
+                tenant_alerts.setdefault(alerts_dictionary['managedAgent'], {'high': [], 'medium': []})['medium'].append(
+                    alerts_dictionary)
+                tenant_medium_alert_count += 1
+                if log_machines:
+                    logger.debug(
+                        f"Alert {bcolours.FAIL}{alerts['description']}{bcolours.ENDC} found. Event type - {bcolours.FAIL}{alerts['type']}{bcolours.ENDC}."
+                        f"Type - {bcolours.FAIL}{alerts['category']}{bcolours.ENDC}. Alert date - {bcolours.OKBLUE}{alerts['raisedAt']}{bcolours.ENDC}.")
         if 'nextKey' in alerts_json['pages']:
             next_page = alerts_json['pages']['nextKey']
             # Change URL to get the next page of computers
@@ -1022,131 +2624,334 @@ def get_all_alerts(tenant_token, url, sub_estate_name):
     # Debug - Put the sub estate name you want to debug in the line below
     if sub_estate_name == debug_sub_estate:
         print(f'Put breakpoint here - sub estate - {sub_estate_name}')
-    print(
-        f"Alerts found in {sub_estate_name}. High - {len(list_of_high_alerts)}. Medium - {len(list_of_medium_alerts)}")
-    return list_of_medium_alerts, list_of_high_alerts
+    logger.info(
+        f"Alerts found in {sub_estate_name}. High - {tenant_high_alert_count}. Medium - {tenant_medium_alert_count}")
+    run_metrics.add_phase_time('alert_fetch', tenant_token, time.perf_counter() - alerts_start)
+    return tenant_alerts, tenant_medium_alert_count, tenant_high_alert_count
 
 
-def print_report():
-    full_report_path = f"{report_file_path}{report_name}{time_stamp}{'.csv'}"
+def crawl_sub_estate(sub_estate):
+    # Checks one sub estate. Runs in a sub estate worker when Sub_Estate_Workers is more than 1
+    # Debug - If you want to test one particular sub estate put the ID in the line below and uncomment the line
+    # sub_estate['id'] = ''
+    # For example https://api-eu01.central.sophos.com
+    sub_estate_api_url = regional_api_url.replace('{dataRegion}', sub_estate['dataRegion'])
+    return get_all_computers(sub_estate['id'],
+                             f"{sub_estate_api_url}{'/endpoint/v1'}",
+                             sub_estate['showAs'],
+                             f"{sub_estate_api_url}{'/common/v1/alerts?pageSize=1000&severity=high,medium'}",
+                             get_partial_report_path(sub_estate['id'])
+                             )
+
+
+def get_unused_columns():
+    # The columns not needed in the report because of the config file
+    unused_columns = set()
     if mac_address == 0:
-        report_column_names.remove('Mac Addresses')
-        report_column_order.remove('macAddresses')
+        unused_columns.add('macAddresses')
     if versions == 0:
-        report_column_names.remove('Intercept X Version')
-        # report_column_names.remove('Endpoint Protection Version')
-        report_column_names.remove('Core Agent Version')
-        report_column_names.remove('Device Encryption Version')
-        report_column_names.remove('MDR Version')
-        report_column_names.remove('XDR Version')
-        report_column_names.remove('ZTNA Version')
-        report_column_order.remove('v_interceptX')
-        # report_column_order.remove('v_endpointProtection')
-        report_column_order.remove('v_coreAgent')
-        report_column_order.remove('v_deviceEncryption')
-        report_column_order.remove('v_mtr')
-        report_column_order.remove('v_xdr')
-        report_column_order.remove('v_ztna')
+        unused_columns.update(['v_interceptX', 'v_coreAgent', 'v_deviceEncryption', 'v_mtr', 'v_xdr', 'v_ztna'])
     if windows_build_version == 0:
-        report_column_names.remove('Windows Build')
-        report_column_order.remove('windows_build')
+        unused_columns.add('windows_build')
     if cloud_servers == 0:
-        report_column_names.remove('Cloud Provider')
-        report_column_names.remove('InstanceID')
-        report_column_order.remove('provider')
-        report_column_order.remove('instanceid')
+        unused_columns.update(['provider', 'instanceid'])
     if include_alerts == 0:
-        report_column_names.remove('No. High Alerts')
-        report_column_order.remove('number_high_alerts')
-        report_column_names.remove('No. Medium Alerts')
-        report_column_order.remove('number_medium_alerts')
+        unused_columns.update(['number_high_alerts', 'number_medium_alerts'])
     if Show_AAP_Status == 0:
-        report_column_names.remove('AAP Status')
-        report_column_order.remove('AAP_Active')
-        report_column_names.remove('AAP Activated By')
-        report_column_order.remove('AAP_Activated_By')
-        report_column_names.remove('AAP Last Updated')
-        report_column_order.remove('AAP_Last_Updated')
-        report_column_names.remove('AAP Expires')
-        report_column_order.remove('AAP_Expires')
+        unused_columns.update(['AAP_Active', 'AAP_Activated_By', 'AAP_Last_Updated', 'AAP_Expires'])
     if full_services_list == 0:
-        # Code to try and remove  in a neater way.
-        for columns in services_list:
-            report_column_names.remove(columns)
-            report_column_order.remove(columns)
+        unused_columns.update(services_list)
     if organization_type == "tenant":
         # Removes sub estate name from report if the console is a single tenant
-        report_column_names.remove('Sub Estate')
-        report_column_order.remove('Sub Estate')
+        unused_columns.add('Sub Estate')
     if include_sse_id == 0:
-        report_column_names.remove('Sub EstateID')
-        report_column_order.remove('Sub EstateID')
-    with open(full_report_path, 'w',encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(['High alerts found', len(list_of_high_alerts)])
-        writer.writerow(['Medium alerts found', len(list_of_medium_alerts)])
-        writer.writerow(report_column_names)
-    # Sets the column order
-    with open(full_report_path, 'a+', encoding='utf-8', newline='') as output_file:
-        dict_writer = csv.DictWriter(output_file, report_column_order)
-        dict_writer.writerows(computer_list)
+        unused_columns.add('Sub EstateID')
+    return unused_columns
+
+
+def print_report(report_name, partial_report_paths, high_alerts_found, medium_alerts_found, max_high_alerts,
+                 max_medium_alerts, sub_estate_token=None, remove_partial_reports=True):
+    # sub_estate_token is only used to label the report writing time. None when the report has every sub estate
+    # The partial reports are kept when a sub estate was not finished so --resume can carry on with it
+    print_start = time.perf_counter()
+    full_report_path = f"{report_file_path}{report_name}{time_stamp}{'.csv'}"
+    # The report is opened once. The rows go out in large blocks rather than a row at a time
+    with open(full_report_path, 'w', encoding='utf-8', newline='', buffering=report_buffer_size) as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(['High alerts found', high_alerts_found])
+        writer.writerow(['Medium alerts found', medium_alerts_found])
+        writer.writerow(report_schema.get_column_names(max_high_alerts, max_medium_alerts))
+        # Copies the rows from the partial reports a row at a time and moves the alerts into their columns
+        for partial_report_path in partial_report_paths:
+            with open(partial_report_path, encoding='utf-8', newline='') as partial_report_file:
+                writer.writerows(report_schema.make_report_row(partial_row, max_high_alerts, max_medium_alerts)
+                                 for partial_row in csv.reader(partial_report_file))
+            if remove_partial_reports:
+                os.remove(partial_report_path)
+    run_metrics.add_phase_time('report_writing', sub_estate_token, time.perf_counter() - print_start)
 
 
+class ReportWriter:
+    # Writes the sub estate reports in the background when Split_EDB_Reports is 1 so the next sub estate is checked
+    # while the last one is written. The reports are written one at a time in the order they were added
+    # The queue holds at most queue_size reports so the partial reports waiting to be written do not build up
+    def __init__(self, queue_size):
+        self.report_queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.write_reports, daemon=True)
+        self.thread.start()
+
+    def write_reports(self):
+        while True:
+            report = self.report_queue.get()
+            if report is None:
+                return
+            # Once a report fails the rest are not written. The error is raised in the main thread
+            if self.error is None:
+                print_arguments, written = report
+                try:
+                    print_report(*print_arguments)
+                    if written is not None:
+                        written()
+                except Exception as error:
+                    self.error = error
+
+    def add_report(self, print_arguments, written=None):
+        # written is called once the report is on disk. Waits if the queue is full
+        self.check_error()
+        self.report_queue.put((print_arguments, written))
+
+    def finish(self):
+        # Waits for the reports in the queue to be written
+        self.report_queue.put(None)
+        self.thread.join()
+        self.check_error()
+
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
+
+command_line = parse_arguments()
 client_id, client_secret, report_name, report_file_path, mac_address, versions, windows_build_version, cloud_servers, \
-    include_alerts, full_services_list, split_edb_reports, include_sse_id, list_machines_with_issues_only, show_sse_menu, list_machines_in_group,Show_AAP_Status = read_config()
-token_url = 'https://id.sophos.com/api/v2/oauth2/token'
-headers = get_bearer_token(client_id, client_secret, token_url)
-organization_id, organization_header, organization_type, region_url = get_whoami()
-report_column_names, report_column_order = report_field_names()
+    include_alerts, full_services_list, split_edb_reports, include_sse_id, list_machines_with_issues_only, show_sse_menu, list_machines_in_group,Show_AAP_Status, \
+    sub_estate_workers, connection_pool_size, aap_workers, tenant_requests_per_second, region_requests_per_second, \
+    api_max_retries, page_prefetch, incremental_crawl, endpoint_store_path, full_crawl_hours, \
+    response_cache_path, response_cache_size, bypass_response_cache, whoami_cache_minutes, \
+    tenants_cache_minutes, json_lines_output, parquet_output, history_database_path, log_level, show_progress, \
+    progress_updates_per_second, token_url, global_api_url, regional_api_url, metrics_json_path, \
+    metrics_prometheus_path, shard_processes, checkpoint_path, report_writer_queue, \
+    report_buffer_size = read_config(command_line)
+# A shard process gets the sub estates, time stamp and report folder from the main process
+# Its extra outputs go to shard files that the main process adds to its own
+shard_run = None
+if command_line.shard_run is not None:
+    with open(command_line.shard_run, encoding='utf-8') as shard_run_file:
+        shard_run = json.load(shard_run_file)
+    time_stamp = shard_run['time_stamp']
+    report_file_path = shard_run['report_file_path']
+    region_requests_per_second = region_requests_per_second / shard_run['shard_count']
+    show_progress = 0
+    show_sse_menu = 0
+    metrics_json_path = ''
+    metrics_prometheus_path = ''
+    if json_lines_output != '':
+        json_lines_output = get_shard_path(command_line.shard, '.jsonl')
+    if parquet_output != '':
+        parquet_output = get_shard_path(command_line.shard, '.parquet')
+# The checkpoint says how far the run has got. A resumed run uses the time stamp and report folder of the run it carries
+# on with so the partial reports and report names match. Shard processes use the run the main process started
+checkpoint_store = None
+checkpoint_run = None
+if checkpoint_path != '':
+    checkpoint_store = CheckpointStore(checkpoint_path)
+    if command_line.resume:
+        checkpoint_run = checkpoint_store.get_run()
+    if checkpoint_run is not None:
+        time_stamp, report_file_path = checkpoint_run
+    elif shard_run is None:
+        checkpoint_store.start_run(time_stamp, report_file_path)
+# The sub estates chosen on the command line. Empty for all
+selected_tenant_ids = command_line.tenant_id
+tenant_name_pattern = command_line.tenant_name
+selected_data_regions = command_line.data_region
+# The JSON Lines output is opened before anything is printed so the console output can be moved to stderr
+json_lines_writer = None
+json_lines_file = None
+if json_lines_output == '-':
+    json_lines_writer = JsonLinesWriter(sys.stdout)
+    sys.stdout = sys.stderr
+elif json_lines_output != '':
+    json_lines_file = open(json_lines_output, 'w', encoding='utf-8')
+    json_lines_writer = JsonLinesWriter(json_lines_file)
+# Set up the console output. It follows stdout to stderr when the JSON Lines output is on stdout
+progress_display = None
+if show_progress == 1:
+    progress_display = ProgressDisplay(progress_updates_per_second, sys.stdout)
+console_handler = ConsoleHandler(sys.stdout)
+console_handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(console_handler)
+logger.setLevel(log_level)
+# Shown once the console output has been set up so it never goes into the JSON Lines output on stdout
+if command_line.resume and checkpoint_run is None and shard_run is None:
+    logger.warning(f"No interrupted run in {checkpoint_path} to carry on with. Starting a new run")
+# Messages for every machine and alert are only made when they will be shown
+log_machines = logger.isEnabledFor(logging.DEBUG)
+# The response cache is only used if a response is cached. It holds the whoami and sub estate details
+response_cache = None
+if response_cache_path != '' and (whoami_cache_minutes > 0 or tenants_cache_minutes > 0):
+    response_cache = ResponseCache(response_cache_path, response_cache_size, bypass_response_cache)
+# The endpoint store is only used for incremental crawls
+endpoint_store = None
+if incremental_crawl == 1:
+    endpoint_store = EndpointStore(endpoint_store_path)
+# Phase times and request counts. Always kept as they cost little, only written if Metrics_JSON or Metrics_Prometheus is set
+run_metrics = RunMetrics()
+token_manager = TokenManager(client_id, client_secret, token_url)
+if shard_run is not None:
+    organization_id, organization_header, organization_type, region_url = shard_run['organization']
+else:
+    organization_id, organization_header, organization_type, region_url = get_whoami()
+report_schema = ReportSchema(*report_field_names(), get_unused_columns())
+parquet_report_writer = None
+if parquet_output != '':
+    if pyarrow is None:
+        logger.error("Parquet_Output needs pyarrow. Install it with pip install pyarrow. No Parquet file will be written")
+    else:
+        parquet_report_writer = ParquetReportWriter(parquet_output)
+history_database = None
+if history_database_path != '':
+    history_database = HistoryDatabase(history_database_path,
+                                       shard_run['history_run_id'] if shard_run is not None else None)
 all_machines_count = 0
-if organization_type != "tenant":
-    print(f"Sophos Central is a {organization_type}")
-    get_all_sub_estates()
+# Sub estates that were not finished. The checkpoint is kept for --resume if there are any
+unfinished_sub_estates = 0
+if shard_run is not None:
+    sub_estate_list.extend(shard_run['sub_estates'])
+    all_machines_count = crawl_shard()
+elif organization_type != "tenant":
+    logger.info(f"Sophos Central is a {organization_type}")
+    # The sub estates are checked as they are listed. get_all_sub_estates adds each one to sub_estate_list first
+    sub_estates = get_all_sub_estates()
     # fieldnames, order, versions = report_field_names()
-    for sub_estates_in_list in range(len(sub_estate_list)):
-        sub_estate = sub_estate_list[sub_estates_in_list]
-        # Debug - If you want to test one particular sub estate put the ID in the line below and uncomment the line
-        # sub_estate['id'] = ''
-        total_machines = get_all_computers(sub_estate['id'],
-                                           f"{'https://api-'}{sub_estate['dataRegion']}"
-                                           f"{'.central.sophos.com/endpoint/v1'}",
-                                           sub_estate['showAs'],
-                                           f"{'https://api-'}{sub_estate['dataRegion']}"
-                                           f"{'.central.sophos.com/common/v1/alerts?pageSize=100'}"
-                                           )
+    if shard_processes > 1:
+        # Very large estates are split between processes. The reports are printed below from their partial reports
+        sub_estate_results = run_shards(sub_estates)
+    elif sub_estate_workers > 1:
+        # Check several sub estates at the same time. map returns the results in sub estate order
+        # map gives each sub estate to a worker as soon as it is listed
+        sub_estate_executor = ThreadPoolExecutor(max_workers=sub_estate_workers)
+        sub_estate_results = sub_estate_executor.map(crawl_sub_estate, sub_estates)
+    else:
+        sub_estate_results = map(crawl_sub_estate, sub_estates)
+    # The partial reports in sub estate order, so the rows are in the same order as a serial run
+    partial_report_paths = []
+    max_high_alerts = 0
+    max_medium_alerts = 0
+    # Sub estate reports are written in the background while the next sub estate is checked
+    report_writer = None
+    if split_edb_reports == 1 and report_writer_queue > 0:
+        report_writer = ReportWriter(report_writer_queue)
+    for sub_estate_index, sub_estate_result in enumerate(sub_estate_results):
+        sub_estate = sub_estate_list[sub_estate_index]
+        # Debug - If you want to test one particular sub estate put the ID in crawl_sub_estate
+        total_machines, partial_report_path, tenant_medium_alert_count, tenant_high_alert_count, \
+            tenant_max_high_alerts, tenant_max_medium_alerts = sub_estate_result
+        if history_database is not None:
+            history_database.add_sub_estate(sub_estate['id'], sub_estate['showAs'], sub_estate['dataRegion'],
+                                            total_machines, tenant_high_alert_count, tenant_medium_alert_count)
         all_machines_count += total_machines
+        sub_estate_finished = is_sub_estate_finished(sub_estate['id'])
+        if not sub_estate_finished:
+            unfinished_sub_estates += 1
         if split_edb_reports == 1:
             #Check Sub Estate does not have an / in the name
             if "/" in sub_estate['showAs']:
                 sub_estate['showAs'] = sub_estate['showAs'].replace("/", "-")
-                print(sub_estate['showAs'])
+                logger.info(sub_estate['showAs'])
             # Change the report name to the sub estate name
             report_name = f"{sub_estate['showAs']}{'_'}"
-            print(f"Printing sub estate - {report_name}")
-            print_report()
-            # Reset report columns ready for next report
-            report_column_names, report_column_order = report_field_names()
-            # Clear lists ready for next report
-            computer_list.clear()
-            list_of_high_alerts.clear()
-            list_of_medium_alerts.clear()
-            print(f"Total Number Of Machines: {all_machines_count}")
+            if checkpoint_store is not None and checkpoint_store.is_printed(sub_estate['id']):
+                # Printed before the run was interrupted
+                logger.info(f"Already printed sub estate - {report_name}")
+            else:
+                logger.info(f"Printing sub estate - {report_name}")
+                print_arguments = (report_name, [partial_report_path], tenant_high_alert_count,
+                                   tenant_medium_alert_count, tenant_max_high_alerts, tenant_max_medium_alerts,
+                                   sub_estate['id'], sub_estate_finished)
+                # The checkpoint only says the report is printed once it is on disk
+                report_written = None
+                if checkpoint_store is not None and sub_estate_finished:
+                    report_written = lambda sub_estate_id=sub_estate['id']: checkpoint_store.set_printed(sub_estate_id)
+                if report_writer is not None:
+                    report_writer.add_report(print_arguments, report_written)
+                else:
+                    print_report(*print_arguments)
+                    if report_written is not None:
+                        report_written()
+            logger.info(f"Total Number Of Machines: {all_machines_count}")
+        else:
+            partial_report_paths.append(partial_report_path)
+            high_alerts_found += tenant_high_alert_count
+            medium_alerts_found += tenant_medium_alert_count
+            max_high_alerts = max(max_high_alerts, tenant_max_high_alerts)
+            max_medium_alerts = max(max_medium_alerts, tenant_max_medium_alerts)
+    if report_writer is not None:
+        report_writer.finish()
+    if shard_processes == 1 and sub_estate_workers > 1:
+        sub_estate_executor.shutdown()
     if split_edb_reports == 0:
-        print(f"Total Number Of Machines: {all_machines_count}")
-        print_report()
+        logger.info(f"Total Number Of Machines: {all_machines_count}")
+        print_report(report_name, partial_report_paths, high_alerts_found, medium_alerts_found, max_high_alerts,
+                     max_medium_alerts, remove_partial_reports=unfinished_sub_estates == 0)
 else:
-    report_column_names, report_column_order = report_field_names()
-    print(f"Sophos Central is a {organization_type}")
-    # Removes sub estate name from report if the console is a single tenant
-    # report_column_names.remove('Sub Estate')
-    # report_column_order.remove('Sub Estate')
-    total_machines = get_all_computers(organization_id,
-                                       f"{region_url}{'/endpoint/v1'}",
-                                       organization_type,
-                                       f"{region_url}{'/common/v1/alerts?pageSize=100'}"
-                                       )
+    logger.info(f"Sophos Central is a {organization_type}")
+    if selected_tenant_ids or tenant_name_pattern is not None or selected_data_regions:
+        logger.warning("Sophos Central is a single tenant. --tenant-id, --tenant-name and --data-region are ignored")
+    if progress_display is not None:
+        progress_display.set_sub_estates_total(1)
+    total_machines, partial_report_path, medium_alerts_found, high_alerts_found, max_high_alerts, max_medium_alerts = \
+        get_all_computers(organization_id,
+                          f"{region_url}{'/endpoint/v1'}",
+                          organization_type,
+                          f"{region_url}{'/common/v1/alerts?pageSize=1000&severity=high,medium'}",
+                          get_partial_report_path(organization_id)
+                          )
     all_machines_count += total_machines
-    print(f"Total Number Of Machines: {all_machines_count}")
-    print_report()
+    if not is_sub_estate_finished(organization_id):
+        unfinished_sub_estates += 1
+    if history_database is not None:
+        history_database.add_sub_estate(organization_id, organization_type, region_url, total_machines,
+                                        high_alerts_found, medium_alerts_found)
+    logger.info(f"Total Number Of Machines: {all_machines_count}")
+    print_report(report_name, [partial_report_path], high_alerts_found, medium_alerts_found, max_high_alerts,
+                 max_medium_alerts, organization_id, unfinished_sub_estates == 0)
+close_api_sessions()
+if response_cache is not None:
+    response_cache.close()
+if progress_display is not None:
+    progress_display.finish()
+if json_lines_file is not None:
+    json_lines_file.close()
+if parquet_report_writer is not None:
+    parquet_report_writer.close()
+if history_database is not None:
+    if shard_run is not None:
+        history_database.close()
+    else:
+        history_database.finish_run(all_machines_count)
+if checkpoint_store is not None:
+    if shard_run is not None:
+        checkpoint_store.close()
+    elif unfinished_sub_estates > 0:
+        logger.error(f"{unfinished_sub_estates} sub estates were not finished. Run the script again with --resume "
+                     f"to carry on with them")
+        checkpoint_store.close()
+    else:
+        checkpoint_store.remove()
 end_time = time.time()
-print(f"Script run time - {timedelta(seconds=end_time - script_start_time)}")
+if metrics_json_path != '':
+    run_metrics.write_json(metrics_json_path, end_time - script_start_time, all_machines_count)
+if metrics_prometheus_path != '':
+    run_metrics.write_prometheus(metrics_prometheus_path, end_time - script_start_time, all_machines_count)
+logger.info(f"Script run time - {timedelta(seconds=end_time - script_start_time)}")
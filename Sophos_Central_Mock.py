@@ -0,0 +1,358 @@
+# Copyright 2019-2020 Sophos Limited
+#
+# Licensed under the GNU General Public License v3.0(the "License"); you may
+# not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at:
+# https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Sophos_Central_Mock.py
+#
+# A local stand in for Sophos Central. Makes up an estate so Sophos_Central_Health.py can be tested and timed
+# without a Sophos Central account or its rate limits
+# Supports the token, whoami, tenants, endpoints, alerts and adaptive-attack-protection API calls
+#
+# Run it then put the URLs it prints in the API section of Sophos_Central_Health.config
+#
+# Version v2026.10
+# README: This script is an unsupported solution provided by Sophos Professional Services
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# The data regions the made up sub estates are put in
+data_regions = ['eu01', 'us01', 'us03', 'de01']
+# The services reported by a Windows machine
+windows_services = ['Sophos MCS Agent', 'Sophos MCS Client', 'Sophos Endpoint Defense Service',
+                    'Sophos File Scanner Service', 'Sophos Health Service', 'Sophos Network Threat Protection',
+                    'Sophos AutoUpdate Service', 'HitmanPro.Alert service']
+# The services reported by a Linux machine
+linux_services = ['Sophos Linux AntiVirus', 'Update Scheduler', 'SophosMcsAgentD', 'SophosScanD']
+
+
+class MockEstate:
+    # A made up estate. The same seed always makes the same estate
+    def __init__(self, id_type='partner', tenants=5, endpoints=500, alerts=100, seed=1, latency=0.0, rate_429=0.0,
+                 retry_after=1, token_lifetime=3600):
+        self.id_type = id_type
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.token_lifetime = token_lifetime
+        self.url = ''
+        self.random = random.Random(seed)
+        self.id = str(uuid.UUID(int=self.random.getrandbits(128)))
+        # Access token -> time it expires
+        self.tokens = {}
+        # Counted for the benchmark
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.requests_429 = 0
+        self.bytes_sent = 0
+        self.tenants = []
+        self.endpoints = {}
+        self.endpoint_index = {}
+        self.alerts = {}
+        # A tenant has one sub estate, itself
+        if id_type == 'tenant':
+            tenants = 1
+        for tenant_number in range(tenants):
+            tenant_id = self.id if id_type == 'tenant' else str(uuid.UUID(int=self.random.getrandbits(128)))
+            data_region = data_regions[tenant_number % len(data_regions)]
+            self.tenants.append({'id': tenant_id,
+                                 'showAs': f"Mock Sub Estate {tenant_number}",
+                                 'name': f"Mock Sub Estate {tenant_number}",
+                                 'dataGeography': data_region[:2].upper(),
+                                 'dataRegion': data_region,
+                                 'billingType': 'trial',
+                                 'partner': {'id': self.id},
+                                 'apiHost': f"https://api-{data_region}.central.sophos.com",
+                                 'status': 'active'})
+            tenant_endpoints = [self.make_endpoint(tenant_id, tenant_number, endpoint_number)
+                                for endpoint_number in range(endpoints)]
+            self.endpoints[tenant_id] = tenant_endpoints
+            for endpoint in tenant_endpoints:
+                self.endpoint_index[endpoint['id']] = endpoint
+            self.alerts[tenant_id] = [self.make_alert(tenant_endpoints, tenant_number, alert_number)
+                                      for alert_number in range(alerts)]
+
+    def make_endpoint(self, tenant_id, tenant_number, endpoint_number):
+        choice = self.random.choice
+        endpoint_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+        platform = choice(['windows', 'windows', 'windows', 'linux', 'macOS'])
+        endpoint_type = choice(['computer', 'computer', 'server'])
+        services = linux_services if platform == 'linux' else windows_services
+        service_details = [{'name': service_name, 'status': choice(['running'] * 9 + ['stopped'])}
+                           for service_name in services]
+        service_status = 'good' if all(service['status'] == 'running' for service in service_details) else 'bad'
+        threat_status = choice(['good'] * 9 + ['bad'])
+        overall = choice(['good', 'good', 'good', 'suspicious', 'bad'])
+        if platform == 'macOS':
+            operating_system = {'isServer': False, 'platform': 'macOS', 'name': 'macOS', 'majorVersion': 14,
+                                'minorVersion': choice([4, 5, 6]), 'build': choice([0, 1])}
+        elif platform == 'linux':
+            operating_system = {'isServer': endpoint_type == 'server', 'platform': 'linux', 'name': 'Ubuntu 22.04',
+                                'majorVersion': 22, 'minorVersion': 4}
+        else:
+            operating_system = {'isServer': endpoint_type == 'server', 'platform': 'windows',
+                                'name': 'Windows Server 2022 Standard' if endpoint_type == 'server'
+                                else 'Windows 11 Pro', 'majorVersion': 10, 'minorVersion': 0,
+                                'build': choice([19045, 22621, 22631, 26100])}
+        endpoint = {'id': endpoint_id,
+                    'type': endpoint_type,
+                    'tenant': {'id': tenant_id},
+                    'hostname': f"mock-{tenant_number}-{endpoint_number}",
+                    'health': {'overall': overall,
+                               'threats': {'status': threat_status},
+                               'services': {'status': service_status, 'serviceDetails': service_details}},
+                    'os': operating_system,
+                    'ipv4Addresses': [f"10.{tenant_number % 256}.{endpoint_number // 256 % 256}.{endpoint_number % 256}"],
+                    'macAddresses': ['02:00:%02X:%02X:%02X:%02X' % (tenant_number % 256, endpoint_number // 65536 % 256,
+                                                                    endpoint_number // 256 % 256,
+                                                                    endpoint_number % 256)],
+                    'associatedPerson': {'name': f"User {endpoint_number}",
+                                         'viaLogin': f"MOCK\\user{endpoint_number}",
+                                         'id': str(uuid.UUID(int=self.random.getrandbits(128)))},
+                    'tamperProtectionEnabled': choice([True, True, False]),
+                    'assignedProducts': [{'code': 'coreAgent', 'version': '2024.3.2.1', 'status': 'installed'},
+                                         {'code': 'interceptX', 'version': '2024.3.1.4', 'status': 'installed'},
+                                         {'code': 'endpointProtection', 'version': '10.8.16', 'status': 'installed'},
+                                         {'code': 'xdr', 'version': '2024.3.1.4',
+                                          'status': choice(['installed', 'notInstalled'])}],
+                    'lastSeenAt': time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                                time.gmtime(time.time() - self.random.randint(0, 90 * 86400))),
+                    'capabilities': choice([[], [], ['mdr']]),
+                    'encryption': {'volumes': choice([[], [{'volumeId': 'C:', 'status': 'encrypted'}],
+                                                      [{'volumeId': 'C:', 'status': 'notEncrypted'}]])},
+                    'group': {'name': choice(['Servers', 'Laptops', 'Desktops'])},
+                    'isolation': {'status': 'notIsolated', 'adminIsolated': False, 'selfIsolated': False},
+                    'lockdown': {'status': 'notInstalled'}}
+        if endpoint_type == 'server' and self.random.random() < 0.2:
+            endpoint['cloud'] = {'provider': choice(['aws', 'azure', 'gcp']),
+                                 'instanceId': f"i-{self.random.getrandbits(64):016x}"}
+        return endpoint
+
+    def make_alert(self, tenant_endpoints, tenant_number, alert_number):
+        choice = self.random.choice
+        alert = {'id': str(uuid.UUID(int=self.random.getrandbits(128))),
+                 'allowedActions': ['acknowledge'],
+                 'category': choice(['malware', 'policy', 'pua', 'runtimeDetections']),
+                 'description': f"Mock alert {alert_number} in sub estate {tenant_number}",
+                 'groupKey': 'mock',
+                 'product': 'endpoint',
+                 'raisedAt': time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                           time.gmtime(time.time() - self.random.randint(0, 30 * 86400))),
+                 'severity': choice(['high', 'medium', 'low', 'low']),
+                 'type': 'Event::Endpoint::Threat::Detected'}
+        # Some alerts are for the console rather than a machine
+        if tenant_endpoints and self.random.random() < 0.9:
+            alert['managedAgent'] = {'id': choice(tenant_endpoints)['id'], 'type': 'computer'}
+        else:
+            alert['managedAgent'] = {'type': 'computer'}
+        return alert
+
+    def get_aap_status(self, endpoint_id):
+        # The same machine always has the same AAP state
+        aap_state = int(endpoint_id[:2], 16) % 4
+        if aap_state == 0:
+            return {}
+        if aap_state == 1:
+            return {'actualState': {'enabled': True, 'lastUpdatedAt': '2026-01-01T00:00:00.000Z',
+                                    'expiresAt': '2026-01-02T00:00:00.000Z'},
+                    'desiredState': {'source': 'automatic'}}
+        return {'actualState': {'enabled': False}, 'desiredState': {'source': 'automatic'}}
+
+
+def get_key_page(items, query, default_page_size, max_page_size):
+    # Key based paging used by the endpoints and alerts API calls
+    page_size = min(int(query.get('pageSize', default_page_size)), max_page_size)
+    first_item = int(query.get('pageFromKey', 0))
+    pages = {'fromKey': str(first_item), 'size': page_size, 'maxSize': max_page_size}
+    if first_item + page_size < len(items):
+        pages['nextKey'] = str(first_item + page_size)
+    if query.get('pageTotal', '').lower() == 'true':
+        pages['total'] = max(1, -(-len(items) // page_size))
+        pages['items'] = len(items)
+    return {'items': items[first_item:first_item + page_size], 'pages': pages}
+
+
+def make_request_handler(estate, verbose=False):
+    class MockRequestHandler(BaseHTTPRequestHandler):
+        # Keep alive so the pooled sessions in Sophos_Central_Health.py are used the same way as with Sophos Central
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, message_format, *args):
+            if verbose:
+                super().log_message(message_format, *args)
+
+        def send_json(self, status_code, body, headers=None):
+            response = json.dumps(body).encode('utf-8')
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            for header, value in (headers or {}).items():
+                self.send_header(header, value)
+            self.end_headers()
+            self.wfile.write(response)
+            with estate.lock:
+                estate.bytes_sent += len(response)
+
+        def start_request(self):
+            # Counts the request, waits for the latency and sometimes says there are too many requests
+            with estate.lock:
+                estate.requests += 1
+                too_many_requests = estate.random.random() < estate.rate_429
+                if too_many_requests:
+                    estate.requests_429 += 1
+            if estate.latency:
+                time.sleep(estate.latency)
+            if too_many_requests:
+                self.send_json(429, {'error': 'TooManyRequests', 'message': 'Too many requests'},
+                               {'Retry-After': str(estate.retry_after)})
+                return False
+            return True
+
+        def do_POST(self):
+            request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not self.start_request():
+                return
+            if urlsplit(self.path).path != '/api/v2/oauth2/token':
+                return self.send_json(404, {'error': 'notFound'})
+            if b'grant_type=client_credentials' not in request_body:
+                return self.send_json(400, {'errorCode': 'invalid_request'})
+            access_token = uuid.uuid4().hex
+            with estate.lock:
+                estate.tokens[access_token] = time.time() + estate.token_lifetime
+            self.send_json(200, {'access_token': access_token, 'errorCode': 'success', 'expires_in':
+                                 estate.token_lifetime, 'message': 'OK', 'refresh_token': '', 'token_type': 'bearer'})
+
+        def do_GET(self):
+            if not self.start_request():
+                return
+            url_parts = urlsplit(self.path)
+            path = url_parts.path
+            query = {key: values[0] for key, values in parse_qs(url_parts.query).items()}
+            # Every API call needs a token that has not expired
+            access_token = self.headers.get('Authorization', '')[len('Bearer '):]
+            with estate.lock:
+                token_expires = estate.tokens.get(access_token, 0)
+            if token_expires < time.time():
+                return self.send_json(401, {'error': 'Unauthorized', 'message': 'Token is not valid'})
+            if path == '/whoami/v1':
+                whoami = {'id': estate.id, 'idType': estate.id_type,
+                          'apiHosts': {'global': estate.url}}
+                if estate.id_type == 'tenant':
+                    whoami['apiHosts']['dataRegion'] = estate.url
+                return self.send_json(200, whoami)
+            tenants_match = re.match(r'^/(partner|organization)/v1/tenants$', path)
+            if tenants_match:
+                # Page number paging used by the tenants API call
+                id_header = 'X-Partner-ID' if tenants_match.group(1) == 'partner' else 'X-Organization-ID'
+                if estate.id_type != tenants_match.group(1) or self.headers.get(id_header) != estate.id:
+                    return self.send_json(403, {'error': 'Forbidden'})
+                page_size = min(int(query.get('pageSize', 50)), 100)
+                page = int(query.get('page', 1))
+                pages = {'current': page, 'size': page_size, 'maxSize': 100}
+                if query.get('pageTotal', '').lower() == 'true':
+                    pages['total'] = max(1, -(-len(estate.tenants) // page_size))
+                    pages['items'] = len(estate.tenants)
+                return self.send_json(200, {'items': estate.tenants[(page - 1) * page_size:page * page_size],
+                                            'pages': pages})
+            tenant_match = re.match(r'^/(partner|organization)/v1/tenants/([^/]+)$', path)
+            if tenant_match:
+                id_header = 'X-Partner-ID' if tenant_match.group(1) == 'partner' else 'X-Organization-ID'
+                if estate.id_type != tenant_match.group(1) or self.headers.get(id_header) != estate.id:
+                    return self.send_json(403, {'error': 'Forbidden'})
+                for tenant in estate.tenants:
+                    if tenant['id'] == tenant_match.group(2):
+                        return self.send_json(200, tenant)
+                return self.send_json(404, {'error': 'ResourceNotFound'})
+            tenant_id = self.headers.get('X-Tenant-ID')
+            if tenant_id not in estate.endpoints:
+                return self.send_json(403, {'error': 'Forbidden'})
+            if path == '/endpoint/v1/endpoints':
+                endpoints = estate.endpoints[tenant_id]
+                if 'ids' in query:
+                    endpoint_ids = set(query['ids'].split(','))
+                    endpoints = [endpoint for endpoint in endpoints if endpoint['id'] in endpoint_ids]
+                endpoint_page = get_key_page(endpoints, query, 50, 500)
+                if 'fields' in query:
+                    fields = query['fields'].split(',')
+                    endpoint_page['items'] = [{field: endpoint[field] for field in fields if field in endpoint}
+                                              for endpoint in endpoint_page['items']]
+                return self.send_json(200, endpoint_page)
+            aap_match = re.match(r'^/endpoint/v1/endpoints/([^/]+)/adaptive-attack-protection$', path)
+            if aap_match:
+                endpoint = estate.endpoint_index.get(aap_match.group(1))
+                if endpoint is None or endpoint['tenant']['id'] != tenant_id:
+                    return self.send_json(404, {'error': 'ResourceNotFound'})
+                return self.send_json(200, estate.get_aap_status(endpoint['id']))
+            if path == '/common/v1/alerts':
+                alerts = estate.alerts[tenant_id]
+                if 'severity' in query:
+                    severities = query['severity'].split(',')
+                    alerts = [alert for alert in alerts if alert['severity'] in severities]
+                return self.send_json(200, get_key_page(alerts, query, 50, 1000))
+            return self.send_json(404, {'error': 'notFound'})
+
+    return MockRequestHandler
+
+
+def start_mock_server(estate, host='127.0.0.1', port=0, verbose=False):
+    # Port 0 uses any free port. The URL is in estate.url once the server has started
+    mock_server = ThreadingHTTPServer((host, port), make_request_handler(estate, verbose))
+    mock_server.daemon_threads = True
+    estate.url = f"http://{host}:{mock_server.server_address[1]}"
+    threading.Thread(target=mock_server.serve_forever, daemon=True).start()
+    return mock_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand in for Sophos Central')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--type', dest='id_type', choices=['partner', 'organization', 'tenant'], default='partner')
+    parser.add_argument('--tenants', type=int, default=5, help='Number of sub estates')
+    parser.add_argument('--endpoints', type=int, default=500, help='Machines in each sub estate')
+    parser.add_argument('--alerts', type=int, default=100, help='Alerts in each sub estate')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--rate-429', type=float, default=0.0,
+                        help='Share of requests answered with 429 Too Many Requests. For example 0.05')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429')
+    parser.add_argument('--token-lifetime', type=int, default=3600, help='Seconds an access token lasts')
+    parser.add_argument('--verbose', action='store_true', help='Print every request')
+    arguments = parser.parse_args()
+    estate = MockEstate(arguments.id_type, arguments.tenants, arguments.endpoints, arguments.alerts, arguments.seed,
+                        arguments.latency, arguments.rate_429, arguments.retry_after, arguments.token_lifetime)
+    start_mock_server(estate, arguments.host, arguments.port, arguments.verbose)
+    print(f"Mock Sophos Central is a {arguments.id_type} with {len(estate.tenants)} sub estates and "
+          f"{len(estate.endpoint_index)} machines")
+    print('Put these lines in the API section of Sophos_Central_Health.config. Any ClientID and ClientSecret work')
+    print(f"Token_URL:{estate.url}/api/v2/oauth2/token")
+    print(f"Global_API_URL:{estate.url}")
+    print(f"Regional_API_URL:{estate.url}")
+    print('Press Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print(f"Requests {estate.requests}. Too many requests sent {estate.requests_429}")
+
+
+if __name__ == '__main__':
+    main()